@@ -1,19 +1,71 @@
 #!/usr/bin/env python
 
+import re
 import logging
 
 from google.appengine.api import memcache
+from google.appengine.api import taskqueue
+from google.appengine.ext import db
 from google.appengine.ext import webapp
 from google.appengine.ext.webapp.util import run_wsgi_app
+from django.utils import simplejson
 
-from lib import BaseRequest, get_cache
+from lib import BaseRequest, get_cache, get_textile_stats, put_in_batches
+from models import Project, Issue, Event, RecentCommits, DatastoreFile, FileBlob, Migration
+from models import WebHookPayload
 import settings
 
+# regex for the issue references in commit messages, optionally
+# with a verb before them as in "fixes bug #gitbug52"
+GITBUG = re.compile(r'(?:\b([a-z]+)\W+(?:(?:bugs?|issues?)\W+)?)?#gitbug([0-9]+)', re.IGNORECASE)
+
+# what the verbs before a reference do to the issue
+VERBS = {
+    'fix': 'fixed',
+    'fixes': 'fixed',
+    'fixed': 'fixed',
+    'close': 'fixed',
+    'closes': 'fixed',
+    'closed': 'fixed',
+    'ref': 'referenced',
+    'refs': 'referenced',
+    'references': 'referenced',
+    'see': 'referenced',
+    'reopen': 'reopened',
+    'reopens': 'reopened',
+    'reopened': 'reopened',
+}
+
+def commit_references(message):
+    """
+    The (action, identifier) of each issue referenced in a commit
+    message. A verb applies to the references after it, so "refs
+    #gitbug1, #gitbug2" references both, and references without
+    one fix the issue as they always have
+    """
+    references = []
+    action = 'fixed'
+    for verb, identifier in GITBUG.findall(message):
+        action = VERBS.get(verb.lower(), action)
+        references.append((action, int(identifier)))
+    return references
+
 class Index(BaseRequest):
     def get(self):
         stats = memcache.get_stats()
+        phases = []
+        for phase, calls, seconds, size in get_textile_stats().report():
+            phases.append({
+                'name': phase,
+                'calls': calls,
+                'time': seconds * 1000,
+                'average': seconds * 1000 / calls,
+                'size': size / 1024.0,
+            })
         context = {
             'stats': stats,
+            'textile_fallbacks': memcache.get("textile_fallbacks") or 0,
+            'textile_phases': phases,
         }        
         output = self.render("admin.html", context)
         self.response.out.write(output)
@@ -28,6 +80,242 @@ class ClearCache(BaseRequest):
 
         self.redirect("/admin/")
         
+class BackfillHtml(BaseRequest):
+    "Render the descriptions saved while rendering lazily"
+    def get(self):
+        self.post()
+
+    def post(self):
+        remaining = False
+        for model in (Project, Issue):
+            entities = model.all().filter('html_stale =', True).fetch(
+                settings.TEXTILE_BACKFILL_BATCH)
+            rendered = 0
+            for entity in entities:
+                # rendered outside the transaction as it can be slow
+                entity.render_html()
+                if db.run_in_transaction(self.save_html, entity.key(), entity.description, entity.html):
+                    rendered += 1
+            logging.info("rendered %d stale %s descriptions" % (rendered, model.kind()))
+            if len(entities) == settings.TEXTILE_BACKFILL_BATCH:
+                remaining = True
+
+        # keep going in another task until everything is rendered
+        if remaining:
+            taskqueue.add(url="/admin/backfill/")
+            return
+
+        # anything saved stale from now on queues its own task, but
+        # something saved since our queries saw the flag and didn't
+        memcache.delete("textile_backfill")
+        for model in (Project, Issue):
+            if model.all(keys_only=True).filter('html_stale =', True).get() is not None:
+                if memcache.add("textile_backfill", True, 60):
+                    taskqueue.add(url="/admin/backfill/")
+                return
+
+    def save_html(self, key, description, html):
+        """
+        Save the html, unless the entity was edited or rendered since we
+        fetched it. Saved directly so we don't go through the put methods,
+        which would send emails and bump the issue counter
+        """
+        entity = db.get(key)
+        if entity is None or not entity.html_stale or entity.description != description:
+            return False
+        entity.html = html
+        entity.html_stale = False
+        db.put(entity)
+        return True
+
+class AddModifiedDates(BaseRequest):
+    """
+    Set the modified date on issues and projects saved before it
+    existed, so they show up in the feeds and the API which are
+    ordered by it
+    """
+    batch = 100
+
+    def get(self):
+        self.post()
+
+    def post(self):
+        # issues first, then projects
+        if self.request.get("kind") == "Project":
+            model = Project
+        else:
+            model = Issue
+
+        entities = model.all().order('__key__')
+        cursor = self.request.get("cursor")
+        if cursor:
+            entities.with_cursor(cursor)
+        batch = entities.fetch(self.batch)
+
+        changed = [entity for entity in batch if entity.modified_date is None]
+        for entity in changed:
+            entity.modified_date = getattr(entity, 'fixed_date', None) or entity.created_date
+        # saved directly so we don't go through the put method
+        db.put(changed)
+        logging.info("set the modified date on %d %s entities" % (len(changed), model.kind()))
+
+        if len(batch) == self.batch:
+            taskqueue.add(url="/admin/modified/", params={'kind': model.kind(), 'cursor': entities.cursor()})
+        elif model is Issue:
+            taskqueue.add(url="/admin/modified/", params={'kind': 'Project'})
+        else:
+            Migration(key_name="modified_dates").put()
+
+class MoveFileData(BaseRequest):
+    """
+    Move the data of files uploaded before blobs into a FileBlob, so
+    listing a project's files no longer loads every file's data
+    """
+    # each of these files can be up to 1MB
+    batch = 10
+
+    def get(self):
+        self.post()
+
+    def post(self):
+        files = DatastoreFile.all().order('__key__')
+        cursor = self.request.get("cursor")
+        if cursor:
+            files.with_cursor(cursor)
+        batch = files.fetch(self.batch)
+
+        moved = 0
+        for datastore_file in batch:
+            if datastore_file.data is None:
+                continue
+            # each file is saved as soon as it's moved, so a retried
+            # task skips it rather than counting another reference
+            blob = FileBlob.store(datastore_file.data)
+            try:
+                saved = db.run_in_transaction(self.move, datastore_file.key(), blob)
+            except db.TransactionFailedError:
+                # only released when we know the file wasn't saved
+                FileBlob.release(blob.key())
+                raise
+            if saved:
+                moved += 1
+            else:
+                # moved meanwhile by another run of the task
+                FileBlob.release(blob.key())
+        logging.info("moved the data of %d files into blobs" % moved)
+
+        if len(batch) == self.batch:
+            taskqueue.add(url="/admin/files/", params={'cursor': files.cursor()})
+        else:
+            Migration(key_name="file_blobs").put()
+
+    def move(self, key, blob):
+        "Point the file at the blob, unless it has been moved already"
+        datastore_file = DatastoreFile.get(key)
+        if datastore_file is None or datastore_file.data is None:
+            return False
+        datastore_file.blob = blob
+        datastore_file.size = blob.size
+        datastore_file.sha256 = blob.sha256
+        datastore_file.chunk_size = blob.chunk_size
+        datastore_file.chunk_count = blob.chunk_count
+        datastore_file.data = None
+        datastore_file.put()
+        return True
+
+class WebHookWorker(BaseRequest):
+    """
+    Fix the issues referenced by the commits in a webhook payload,
+    queued by the webhook handler
+    """
+    def post(self):
+        stored = WebHookPayload.get(self.request.get("payload"))
+        if stored is None:
+            logging.info("webhook payload already processed")
+            return
+
+        project = Project.get(WebHookPayload.project.get_value_for_datastore(stored))
+        if project is None:
+            logging.info("webhook for a deleted project")
+        else:
+            self.process(project, stored.read())
+        # only deleted once processed, so a retried task has it
+        stored.delete()
+
+    def process(self, project, payload):
+        "Apply the commits in the payload to the project's issues"
+        try:
+            commits = simplejson.loads(payload)['commits']
+        except (ValueError, KeyError, TypeError), e:
+            # retrying the task won't help with a payload we can't read
+            logging.error("webhook error: %s" % e)
+            return
+
+        # senders redeliver payloads when we're slow to answer, so commits
+        # already processed are skipped before looking up any issues
+        recent = RecentCommits.get(RecentCommits.key_for(project))
+        seen = set(recent and recent.ids or [])
+        commit_ids = []
+        new_commits = []
+        for commit in commits:
+            commit_id = commit.get('id')
+            if commit_id in seen:
+                continue
+            if commit_id:
+                seen.add(commit_id)
+                commit_ids.append(commit_id)
+            new_commits.append(commit)
+        if len(new_commits) < len(commits):
+            logging.info("webhook skipped %d commits already processed in %s" % (
+                len(commits) - len(new_commits), project.name))
+
+        # collect the references first so the issues are
+        # fetched together rather than a query for each
+        references = []
+        for commit in new_commits:
+            message = commit.get('message', '')
+            for action, identifier in commit_references(message):
+                references.append((action, identifier, message))
+        issues = Issue.get_by_identifiers(project,
+            [identifier for _, identifier, _ in references])
+
+        # apply the references in the order they were committed,
+        # so each issue ends up as the last commit left it
+        changed = {}
+        events = []
+        for action, identifier, message in references:
+            issue = issues.get(identifier)
+            if issue is None:
+                logging.info("webhook referenced a missing issue: #gitbug%s in %s" % (identifier, project.name))
+                continue
+            if action == "fixed" and not issue.fixed:
+                issue.fixed = True
+                issue.fixed_description = message
+            elif action == "reopened" and issue.fixed:
+                issue.fixed = False
+                issue.fixed_description = None
+            elif action != "referenced":
+                # already the way the commit wants it
+                continue
+            if action != "referenced":
+                changed[identifier] = issue
+            events.append(Event.create(action, issue, source="webhook", project=project))
+            logging.info("issue %s via webhook: %s in %s" % (action, issue.name, project.name))
+
+        # saved directly in batches, as a big push changes more than
+        # one call can put. prepare_put does everything else the put
+        # method would do
+        messages = [issue.prepare_put() for issue in changed.values()]
+        put_in_batches(changed.values() + events)
+        # the emails are only sent once the issues are saved,
+        # so a retried task doesn't send them again
+        for message in messages:
+            if message is not None:
+                message.send()
+
+        if commit_ids:
+            RecentCommits.add(project, commit_ids)
+
 class NotFoundPageHandler(BaseRequest):
     def get(self):
         self.error(404)
@@ -43,6 +331,10 @@ def application():
     ROUTES = [
         ('/admin/?$', Index),
         ('/admin/clearcache/?$', ClearCache),
+        ('/admin/backfill/?$', BackfillHtml),
+        ('/admin/modified/?$', AddModifiedDates),
+        ('/admin/webhook/?$', WebHookWorker),
+        ('/admin/files/?$', MoveFileData),
         ('/.*', NotFoundPageHandler),
     ]
     application = webapp.WSGIApplication(ROUTES, debug=settings.DEBUG)
@@ -11,12 +11,32 @@ import datetime
 # Could make this the base class; will need to add 'publish'
 class WriteXmlMixin:
     def write_xml(self, outfile, encoding = "iso-8859-1"):
+        # Same output as write_sax_xml, but the strings are built
+        # directly and written a chunk at a time.
+        declaration = u'<?xml version="1.0" encoding="%s"?>\n' % encoding
+        outfile.write(declaration.encode(encoding, "xmlcharrefreplace"))
+        for chunk in self.xml_chunks(encoding):
+            outfile.write(chunk)
+
+    def write_sax_xml(self, outfile, encoding = "iso-8859-1"):
         from xml.sax import saxutils
         handler = saxutils.XMLGenerator(outfile, encoding)
         handler.startDocument()
         self.publish(handler)
         handler.endDocument()
 
+    def xml_chunks(self, encoding = "iso-8859-1"):
+        handler = _ListHandler(encoding)
+        _publish(self, handler)
+        yield handler.flush()
+
+    def xml_fragment(self, encoding = "iso-8859-1"):
+        # The XML as unicode, without the declaration, which
+        # can be published again later with RawXml.
+        handler = _ListHandler(encoding)
+        _publish(self, handler)
+        return u''.join(handler.parts)
+
     def to_xml(self, encoding = "iso-8859-1"):
         try:
             import cStringIO as StringIO
@@ -45,6 +65,66 @@ def _opt_element(handler, name, obj):
     _element(handler, name, obj)
 
 
+##
+# The SAX calls for every element of every item are slow, so RSS2
+# and RSSItem also have a fast_publish which builds the strings
+# directly. The output is the same as from saxutils.XMLGenerator.
+def _escape(data, encoding):
+    """escape character data like XMLGenerator.characters"""
+    if not isinstance(data, unicode):
+        data = unicode(data, encoding)
+    return data.replace(u"&", u"&amp;").replace(u">", u"&gt;").replace(u"<", u"&lt;")
+
+class _ListHandler:
+    """implements the handler calls used by 'publish'
+
+    Collects the output as unicode strings, which flush returns
+    encoded the same way XMLGenerator encodes them.
+    """
+    def __init__(self, encoding):
+        self.encoding = encoding
+        self.parts = []
+    def startElement(self, name, attrs):
+        from xml.sax.saxutils import quoteattr
+        self.parts.append(u'<' + name)
+        for (name, value) in attrs.items():
+            self.parts.append(u' %s=%s' % (name, quoteattr(value)))
+        self.parts.append(u'>')
+    def endElement(self, name):
+        self.parts.append(u'</%s>' % name)
+    def characters(self, content):
+        self.parts.append(_escape(content, self.encoding))
+    def ignorableWhitespace(self, content):
+        if not isinstance(content, unicode):
+            content = unicode(content, self.encoding)
+        self.parts.append(content)
+    def flush(self):
+        data = u''.join(self.parts).encode(self.encoding, "xmlcharrefreplace")
+        self.parts = []
+        return data
+
+def _fast_element(handler, name, obj):
+    # Same as _element, without the SAX calls for strings.
+    if obj is None:
+        handler.parts.append(u'<%s></%s>' % (name, name))
+    elif isinstance(obj, basestring):
+        handler.parts.append(u'<%s>%s</%s>' % (name, _escape(obj, handler.encoding), name))
+    else:
+        obj.publish(handler)
+
+def _fast_opt_element(handler, name, obj):
+    if obj is None:
+        return
+    _fast_element(handler, name, obj)
+
+def _publish(obj, handler):
+    # Use fast_publish unless a derived class changed publish.
+    if getattr(obj.publish, "im_func", None) in _fast_publishers:
+        obj.fast_publish(handler)
+    else:
+        obj.publish(handler)
+
+
 def _format_date(dt):
     """convert a datetime into an RFC 822 formatted date
 
@@ -99,6 +179,18 @@ class DateElement:
         _element(handler, self.name, _format_date(self.dt))
 ####
 
+class RawXml:
+    """implements the 'publish' API for XML which is already serialized
+
+    Takes the unicode string from xml_fragment, which is published
+    as it is, so it can be cached and reused in other documents.
+    """
+    def __init__(self, xml):
+        self.xml = xml
+    def publish(self, handler):
+        # both handlers write whitespace without escaping it
+        handler.ignorableWhitespace(self.xml)
+
 class Category:
     """Publish a category element"""
     def __init__(self, category, domain = None):
@@ -282,7 +374,7 @@ class RSS2(WriteXmlMixin):
                  skipHours = None, # a SkipHours with a list of integers
                  skipDays = None,  # a SkipDays with a list of strings
 
-                 items = None,     # list of RSSItems
+                 items = None,     # list or iterator of RSSItems
                  ):
         self.title = title
         self.link = link
@@ -369,6 +461,84 @@ class RSS2(WriteXmlMixin):
         handler.endElement("channel")
         handler.endElement("rss")
 
+    def fast_publish(self, handler):
+        self.publish_channel(handler)
+        for item in self.items:
+            _publish(item, handler)
+        handler.endElement("channel")
+        handler.endElement("rss")
+
+    def publish_channel(self, handler):
+        # The same as the start of publish, up to the items.
+        handler.startElement("rss", self.rss_attrs)
+        handler.startElement("channel", self.element_attrs)
+        _fast_element(handler, "title", self.title)
+        _fast_element(handler, "link", self.link)
+        _fast_element(handler, "description", self.description)
+
+        self.publish_extensions(handler)
+        
+        _fast_opt_element(handler, "language", self.language)
+        _fast_opt_element(handler, "copyright", self.copyright)
+        _fast_opt_element(handler, "managingEditor", self.managingEditor)
+        _fast_opt_element(handler, "webMaster", self.webMaster)
+
+        pubDate = self.pubDate
+        if isinstance(pubDate, datetime.datetime):
+            pubDate = _format_date(pubDate)
+        _fast_opt_element(handler, "pubDate", pubDate)
+
+        lastBuildDate = self.lastBuildDate
+        if isinstance(lastBuildDate, datetime.datetime):
+            lastBuildDate = _format_date(lastBuildDate)
+        _fast_opt_element(handler, "lastBuildDate", lastBuildDate)
+
+        for category in self.categories:
+            if isinstance(category, basestring):
+                _fast_element(handler, "category", category)
+            else:
+                category.publish(handler)
+
+        _fast_opt_element(handler, "generator", self.generator)
+        _fast_opt_element(handler, "docs", self.docs)
+
+        if self.cloud is not None:
+            self.cloud.publish(handler)
+
+        ttl = self.ttl
+        if isinstance(self.ttl, int):
+            ttl = IntElement("ttl", ttl)
+        _fast_opt_element(handler, "tt", ttl)
+
+        if self.image is not None:
+            self.image.publish(handler)
+
+        _fast_opt_element(handler, "rating", self.rating)
+        if self.textInput is not None:
+            self.textInput.publish(handler)
+        if self.skipHours is not None:
+            self.skipHours.publish(handler)
+        if self.skipDays is not None:
+            self.skipDays.publish(handler)
+
+    def xml_chunks(self, encoding = "iso-8859-1"):
+        # One chunk for the channel, then one for each item, so
+        # the items can be written out as they are created.
+        handler = _ListHandler(encoding)
+        if self.publish.im_func not in _fast_publishers:
+            self.publish(handler)
+            yield handler.flush()
+            return
+
+        self.publish_channel(handler)
+        yield handler.flush()
+        for item in self.items:
+            _publish(item, handler)
+            yield handler.flush()
+        handler.endElement("channel")
+        handler.endElement("rss")
+        yield handler.flush()
+
     def publish_extensions(self, handler):
         # Derived classes can hook into this to insert
         # output after the three required fields.
@@ -437,7 +607,38 @@ class RSSItem(WriteXmlMixin):
         
         handler.endElement("item")
 
+    def fast_publish(self, handler):
+        handler.startElement("item", self.element_attrs)
+        _fast_opt_element(handler, "title", self.title)
+        _fast_opt_element(handler, "link", self.link)
+        self.publish_extensions(handler)
+        _fast_opt_element(handler, "description", self.description)
+        _fast_opt_element(handler, "author", self.author)
+
+        for category in self.categories:
+            if isinstance(category, basestring):
+                _fast_element(handler, "category", category)
+            else:
+                category.publish(handler)
+        
+        _fast_opt_element(handler, "comments", self.comments)
+        if self.enclosure is not None:
+            self.enclosure.publish(handler)
+        _fast_opt_element(handler, "guid", self.guid)
+
+        pubDate = self.pubDate
+        if isinstance(pubDate, datetime.datetime):
+            pubDate = _format_date(pubDate)
+        _fast_opt_element(handler, "pubDate", pubDate)
+
+        if self.source is not None:
+            self.source.publish(handler)
+        
+        handler.endElement("item")
+
     def publish_extensions(self, handler):
         # Derived classes can hook into this to insert
         # output after the title and link elements
         pass
+
+_fast_publishers = (RSS2.publish.im_func, RSSItem.publish.im_func)
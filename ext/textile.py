@@ -144,6 +144,17 @@ itex2mml = None
 # yourself.
 SANITIZE = 0
 
+# Rendered blocks can be cached when a cache is passed to
+# textile(). These set the key prefix and the expiry time
+# in seconds of the cached blocks.
+BLOCK_CACHE_PREFIX = 'textile/'
+BLOCK_CACHE_TIME = 86400
+
+# Record the time spent in each phase of the processing
+# in the module level stats object? You can also pass it
+# as an argument to textile().
+PROFILE = 0
+
 # Turn debug on?
 DEBUGLEVEL = 0
 
@@ -161,7 +172,50 @@ import re
 import sys
 import os
 import sgmllib
+import markupbase
 import unicodedata
+import hashlib
+import time
+
+
+class TextileTimeout(Exception):
+    """Raised when a render runs out of its time budget."""
+    pass
+
+
+class TextileStats:
+    """Profile of the phases of processing.
+
+    For each phase this keeps the number of calls, the total time
+    in seconds and the total size of the input. The block functions
+    are recorded as 'block:' followed by the function name.
+    """
+    def __init__(self):
+        self.reset()
+
+    def reset(self):
+        self.phases = {}
+        self.started = time.time()
+
+    def record(self, phase, seconds, size):
+        calls, total, input = self.phases.get(phase, (0, 0.0, 0))
+        self.phases[phase] = (calls + 1, total + seconds, input + size)
+
+    def merge(self, phases):
+        """Add the phases of another profile to this one."""
+        for phase, (calls, seconds, size) in phases.items():
+            total_calls, total, input = self.phases.get(phase, (0, 0.0, 0))
+            self.phases[phase] = (total_calls + calls, total + seconds, input + size)
+
+    def report(self):
+        """Return (phase, calls, seconds, size) tuples, slowest first."""
+        report = [(phase,) + counts for phase, counts in self.phases.items()]
+        report.sort(key=lambda row: row[2], reverse=True)
+        return report
+
+
+# Filled in by process() when profiling.
+stats = TextileStats()
 
 
 def _in_tag(text, tag):
@@ -497,6 +551,170 @@ def html_replace(pattern, replacement, text):
         return ''.join(lines)
 
 
+def _split_tags(text):
+    """Split the text at the HTML tags.
+
+    As with re.split, the text is at the even positions of
+    the list and the tags at the odd ones.
+    """
+    return _tags.split(text)
+
+
+#############################
+# Inline regular expressions, compiled once instead of
+# on each call to the inline functions.
+_tags = re.compile('(<.*?>)')
+
+# Glyphs.
+_glyphs = [(r'''"(?<!\w)\b''', r'''&#8220;'''),                              # double quotes
+           (r'''"''', r'''&#8221;'''),                                       # double quotes
+           (r"""\b'""", r'''&#8217;'''),                                     # single quotes
+           (r"""'(?<!\w)\b""", r'''&#8216;'''),                              # single quotes
+           (r"""'""", r'''&#8217;'''),                                       # single single quote
+           (r'''(\b|^)( )?\.{3}''', r'''\1&#8230;'''),                       # ellipsis
+           (r'''\b---\b''', r'''&#8212;&#8212;'''),                          # double em dash
+           (r'''\s?--\s?''', r'''&#8212;'''),                                # em dash
+           (r'''(\d+)-(\d+)''', r'''\1&#8211;\2'''),                         # en dash (1954-1999)
+           (r'''(\d+)-(\W)''', r'''\1&#8212;\2'''),                          # em dash (1954--)
+           (r'''\s-\s''', r''' &#8211; '''),                                 # en dash
+           (r'''(\d+) ?x ?(\d+)''', r'''\1&#215;\2'''),                      # dimension sign
+           (r'''\b ?(\((tm|TM)\))''', r'''&#8482;'''),                       # trademark
+           (r'''\b ?(\([rR]\))''', r'''&#174;'''),                           # registered
+           (r'''\b ?(\([cC]\))''', r'''&#169;'''),                           # copyright
+           (r'''([^\s])\[(\d+)\]''',                                         #
+                r'''\1<sup class="footnote"><a href="#fn\2">\2</a></sup>'''),# footnote
+           ]
+_glyphs = [(re.compile(search), replace) for search, replace in _glyphs]
+
+_macro = re.compile(r'''{([^}]+)}''')
+
+# Linkify URL and emails.
+_linkify_url = r'''(?=[a-zA-Z0-9./#])                          # Must start correctly
+                    ((?:                                        # Match the leading part (proto://hostname, or just hostname)
+                        (?:ftp|https?|telnet|nntp)              #     protocol
+                        ://                                     #     ://
+                        (?:                                     #     Optional 'username:password@'
+                            \w+                                 #         username
+                            (?::\w+)?                           #         optional :password
+                            @                                   #         @
+                        )?                                      # 
+                        [-\w]+(?:\.\w[-\w]*)+                   #     hostname (sub.example.com)
+                    )                                           #
+                    (?::\d+)?                                   # Optional port number
+                    (?:                                         # Rest of the URL, optional
+                        /?                                      #     Start with '/'
+                        [^.!,?;:"'<>()\[\]{}\s\x7F-\xFF]*       #     Can't start with these
+                        (?:                                     #
+                            [.!,?;:]+                           #     One or more of these
+                            [^.!,?;:"'<>()\[\]{}\s\x7F-\xFF]+   #     Can't finish with these
+                            #'"                                 #     # or ' or "
+                        )*                                      #
+                    )?)                                         #
+                '''
+
+_linkify_email = r'''(?:mailto:)?            # Optional mailto:
+                      ([-\+\w]+               # username
+                      \@                      # at
+                      [-\w]+(?:\.\w[-\w]*)+)  # hostname
+                  '''
+
+_linkify_url = re.compile(_linkify_url, re.VERBOSE)
+_linkify_email = re.compile(_linkify_email, re.VERBOSE)
+
+# Acronyms.
+_acronym = re.compile(r'''(?P<acronym>[\w]+)\((?P<definition>[^\(\)]+?)\)''')
+_capitals = re.compile('[A-Z\d]+')
+_caps = re.compile(r'''(^|\s)([A-Z]{3,})\b(?!\()''')
+
+# itex and superscript.
+_itex = re.compile('\$(.*?)\$')
+_superscript = re.compile(r'''(?<!\^)\^(?!\^)(.+?)(?<!\^)\^(?!\^)''')
+
+# Quick tags.
+_qtags = [('**', 'b',      {'qf': '(?<!\*)\*\*(?!\*)', 'cls': '\*'}),
+          ('__', 'i',      {'qf': '(?<!_)__(?!_)', 'cls': '_'}),
+          ('??', 'cite',   {'qf': '\?\?(?!\?)', 'cls': '\?'}),
+          ('-',  'del',    {'qf': '(?<!\-)\-(?!\-)', 'cls': '-'}),
+          ('+',  'ins',    {'qf': '(?<!\+)\+(?!\+)', 'cls': '\+'}),
+          ('*',  'strong', {'qf': '(?<!\*)\*(?!\*)', 'cls': '\*'}),
+          ('_',  'em',     {'qf': '(?<!_)_(?!_)', 'cls': '_'}),
+          ('++', 'big',    {'qf': '(?<!\+)\+\+(?!\+)', 'cls': '\+\+'}),
+          ('--', 'small',  {'qf': '(?<!\-)\-\-(?!\-)', 'cls': '\-\-'}),
+          ('~',  'sub',    {'qf': '(?<!\~)\~(?!(\\\/~))', 'cls': '\~'}),
+          ('@',  'code',   {'qf': '(?<!@)@(?!@)', 'cls': '@'}),
+          ('%',  'span',   {'qf': '(?<!%)%(?!%)', 'cls': '%'}),
+          ]
+
+# This is from the perl version of Textile.
+_qtags = [(htmltag, re.compile(r'''(?:                          #
+                                       ^                        # Start of string
+                                       |                        #
+                                       (?<=[\s>'"])             # Whitespace, end of tag, quotes
+                                       |                        #
+                                       (?P<pre>[{[])            # Surrounded by [ or {
+                                       |                        #
+                                       (?<=%(punct)s)           # Punctuation
+                                   )                            #
+                                   %(qf)s                       # opening tag
+                                   %(qattr)s                    # attributes
+                                   (?P<text>[^%(cls)s\s].*?)    # text
+                                   (?<=\S)                      # non-whitespace
+                                   %(qf)s                       # 
+                                   (?:                          #
+                                       $                        # End of string
+                                       |                        #
+                                       (?P<post>[\]}])          # Surrounded by ] or }
+                                       |                        # 
+                                       (?=%(punct)s{1,2}|\s)    # punctuation
+                                    )                           #
+                                 ''' % dict(res, **redict), re.VERBOSE))
+          for qtag, htmltag, redict in _qtags]
+
+# Images.
+_image = re.compile(r'''\!               # Opening !
+                        %(iattr)s        # Image attributes
+                        (?P<src>%(url)s) # Image src
+                        \s?              # Optional whitesapce
+                        (                #
+                            \(           #
+                            (?P<alt>.*?) # Optional (alt) attribute
+                            \)           #
+                        )?               #
+                        \s?              # Optional whitespace
+                        %(resize)s       # Resize parameters
+                        \!               # Closing !
+                        (                # Optional link
+                            :            #    starts with ':'
+                            (?P<link>    #    
+                            %(url)s      #    link HREF
+                            )            #
+                        )?               #
+                     ''' % res, re.VERBOSE)
+
+# Links.
+_links = [r'''\[                           # [
+              (?P<quote>"|')               # Opening quotes
+              %(lattr)s                    # Link attributes
+              (?P<text>[^"]+?)             # Link text
+              \s?                          # Optional whitespace
+              (?:\((?P<title>[^\)]+?)\))?  # Optional (title)
+              (?P=quote)                   # Closing quotes
+              :                            # :
+              (?P<href>[^\]]+)             # HREF
+              \]                           # ]
+           ''' % res,
+          r'''(?P<quote>"|')               # Opening quotes
+              %(lattr)s                    # Link attributes
+              (?P<text>[^"]+?)             # Link text
+              \s?                          # Optional whitespace
+              (?:\((?P<title>[^\)]+?)\))?  # Optional (title)
+              (?P=quote)                   # Closing quotes
+              :                            # :
+              (?P<href>%(url)s)            # HREF
+           ''' % res]
+_links = [re.compile(link, re.VERBOSE) for link in _links]
+
+
 # PyTextile can optionally sanitize the generated XHTML,
 # which is good for weblog comments. This code is from
 # Mark Pilgrim's feedparser.
@@ -632,6 +850,233 @@ class _HTMLSanitizer(_BaseHTMLProcessor):
             _BaseHTMLProcessor.handle_data(self, text)
 
 
+class _DeclarationScanner(markupbase.ParserBase):
+    """Scanner for <!...> declarations.
+
+    Declarations are rare in Textile output, so instead of porting
+    markupbase's DOCTYPE scanner we borrow it, with the same settings
+    sgmllib uses. Declarations are always dropped by the sanitizer.
+    """
+    _decl_otherchars = '='
+
+    def __init__(self):
+        self.reset()
+
+    def error(self, message):
+        raise sgmllib.SGMLParseError(message)
+
+    def handle_decl(self, data):
+        pass
+
+
+class _StreamSanitizer:
+    """Single pass HTML sanitizer.
+
+    This is a drop-in replacement for _HTMLSanitizer. It tokenizes the
+    markup in one pass using the same regular expressions as sgmllib,
+    but writes the sanitized pieces directly instead of dispatching a
+    method call for every tag, and checks the allowlists in frozensets.
+    The output is the same as _HTMLSanitizer's for the same input.
+    """
+    acceptable_elements = frozenset(_HTMLSanitizer.acceptable_elements)
+    acceptable_attributes = frozenset(_HTMLSanitizer.acceptable_attributes)
+    unacceptable_elements_with_end_tag = frozenset(_HTMLSanitizer.unacceptable_elements_with_end_tag)
+    elements_no_end_tag = frozenset(_BaseHTMLProcessor.elements_no_end_tag)
+
+    def __init__(self):
+        self.reset()
+
+    def reset(self):
+        self.pieces = []
+        self.rawdata = ''
+        self.lasttag = '???'
+        self.unacceptablestack = 0
+        self.declarations = None
+
+    def feed(self, data):
+        """Sanitize some data.
+
+        As with sgmllib, an incomplete construct at the end of the data
+        is kept back until more data is fed.
+        """
+        self.rawdata = self.rawdata + data
+        self.goahead()
+
+    def output(self):
+        """Return processed HTML as a single string"""
+        return ''.join(self.pieces)
+
+    def goahead(self):
+        rawdata = self.rawdata
+        append = self.pieces.append
+        i = 0
+        n = len(rawdata)
+        while i < n:
+            match = sgmllib.interesting.search(rawdata, i)
+            if match: j = match.start()
+            else: j = n
+            if i < j and not self.unacceptablestack:
+                append(rawdata[i:j])
+            i = j
+            if i == n: break
+
+            if rawdata[i] == '<':
+                if sgmllib.starttagopen.match(rawdata, i):
+                    k = self.parse_starttag(i)
+                    if k < 0: break
+                    i = k
+                    continue
+                if rawdata.startswith('</', i):
+                    match = sgmllib.endbracket.search(rawdata, i+1)
+                    if not match: break
+                    j = match.start()
+                    self.endtag(rawdata[i+2:j].strip().lower())
+                    if rawdata[j] == '>': j = j+1
+                    i = j
+                    continue
+                if rawdata.startswith('<!--', i):
+                    match = markupbase._commentclose.search(rawdata, i+4)
+                    if not match: break
+                    append('<!--%s-->' % rawdata[i+4:match.start()])
+                    i = match.end()
+                    continue
+                if rawdata.startswith('<?', i):
+                    # Processing instructions are dropped.
+                    match = sgmllib.piclose.search(rawdata, i+2)
+                    if not match: break
+                    i = match.end()
+                    continue
+                if rawdata.startswith('<!', i):
+                    # Declarations are dropped.
+                    if self.declarations is None:
+                        self.declarations = _DeclarationScanner()
+                    self.declarations.rawdata = rawdata
+                    k = self.declarations.parse_declaration(i)
+                    if k < 0: break
+                    i = k
+                    continue
+            else:
+                match = sgmllib.charref.match(rawdata, i) or sgmllib.entityref.match(rawdata, i)
+                if match:
+                    # Character and entity references are kept even
+                    # inside <script>, as in _BaseHTMLProcessor.
+                    if match.re is sgmllib.charref:
+                        append('&#%s;' % match.group(1))
+                    else:
+                        append('&%s;' % match.group(1))
+                    i = match.end()
+                    if rawdata[i-1] != ';': i = i-1
+                    continue
+
+            # A stray '<' or '&', or something we can't finish yet.
+            j = sgmllib.incomplete.match(rawdata, i).end()
+            if j == n: break
+            if not self.unacceptablestack:
+                append(rawdata[i:j])
+            i = j
+
+        self.rawdata = rawdata[i:]
+
+    def parse_starttag(self, i):
+        rawdata = self.rawdata
+        if sgmllib.shorttagopen.match(rawdata, i):
+            # SGML shorthand: <tag/data/ == <tag>data</tag>
+            match = sgmllib.shorttag.match(rawdata, i)
+            if not match:
+                return -1
+            tag, data = match.group(1, 2)
+            tag = tag.lower()
+            self.starttag(tag, i, i)
+            if not self.unacceptablestack:
+                self.pieces.append(data)
+            self.endtag(tag)
+            return match.end()
+
+        match = sgmllib.endbracket.search(rawdata, i+1)
+        if not match:
+            return -1
+        j = match.start()
+        if rawdata[i:i+2] == '<>':
+            # SGML shorthand: <> == <last open tag seen>
+            k = j
+            tag = self.lasttag
+        else:
+            k = sgmllib.tagfind.match(rawdata, i+1).end()
+            tag = rawdata[i+1:k].lower()
+            self.lasttag = tag
+        self.starttag(tag, k, j)
+        if rawdata[j] == '>':
+            j = j+1
+        return j
+
+    def starttag(self, tag, k, j):
+        """Output a start tag whose attributes are in rawdata[k:j]."""
+        if tag not in self.acceptable_elements:
+            if tag in self.unacceptable_elements_with_end_tag:
+                self.unacceptablestack += 1
+            return
+
+        rawdata = self.rawdata
+        acceptable_attributes = self.acceptable_attributes
+        strattrs = []
+        while k < j:
+            match = sgmllib.attrfind.match(rawdata, k)
+            if not match: break
+            attrname, rest, attrvalue = match.group(1, 2, 3)
+            k = match.end()
+            if not rest:
+                attrvalue = attrname
+            else:
+                if (attrvalue[:1] == "'" == attrvalue[-1:] or
+                    attrvalue[:1] == '"' == attrvalue[-1:]):
+                    # strip quotes
+                    attrvalue = attrvalue[1:-1]
+                attrvalue = sgmllib.SGMLParser.entity_or_charref.sub(_convert_ref, attrvalue)
+
+            # Same as _BaseHTMLProcessor.normalize_attrs.
+            attrname = attrname.lower()
+            attrvalue = sgmllib.charref.sub(lambda m: unichr(int(m.groups()[0])), attrvalue).strip()
+            if attrname in ('rel', 'type'):
+                attrvalue = attrvalue.lower()
+
+            if attrname in acceptable_attributes:
+                strattrs.append(' %s="%s"' % (attrname, attrvalue))
+
+        if tag in self.elements_no_end_tag:
+            self.pieces.append('<%s%s />' % (tag, ''.join(strattrs)))
+        else:
+            self.pieces.append('<%s%s>' % (tag, ''.join(strattrs)))
+
+    def endtag(self, tag):
+        if tag not in self.acceptable_elements:
+            if tag in self.unacceptable_elements_with_end_tag:
+                self.unacceptablestack -= 1
+            return
+        if tag not in self.elements_no_end_tag:
+            self.pieces.append('</%s>' % tag)
+
+
+def _sanitize(text):
+    """Sanitize the generated XHTML."""
+    p = _StreamSanitizer()
+    p.feed(text)
+    return p.output()
+
+
+def _convert_ref(match):
+    """Convert a reference inside an attribute value, like sgmllib."""
+    if match.group(2):
+        n = int(match.group(2))
+        if 0 <= n <= 127:
+            return chr(n)
+        return '&#%s%s' % match.groups()[1:]
+    elif match.group(3):
+        return sgmllib.SGMLParser.entitydefs.get(match.group(1)) or \
+            '&%s;' % match.group(1)
+    else:
+        return '&%s' % match.group(1)
+
+
 class Textiler:
     """Textile formatter.
 
@@ -645,6 +1090,12 @@ class Textiler:
         """
         self.text = text
 
+        # No time limit unless process() is given one.
+        self.deadline = None
+
+        # Don't record the phases in stats unless asked to.
+        self.profile = 0
+
         # Basic regular expressions.
         self.res = res
 
@@ -818,51 +1269,136 @@ class Textiler:
         return links
 
 
-    def process(self, head_offset=HEAD_OFFSET, validate=VALIDATE, sanitize=SANITIZE, output=OUTPUT, encoding=ENCODING):
+    def process(self, head_offset=HEAD_OFFSET, validate=VALIDATE, sanitize=SANITIZE, output=OUTPUT, encoding=ENCODING, cache=None, timeout=None, profile=PROFILE):
         """Process the text.
 
         Here we actually process the text, splitting the text in
         blocks and applying the corresponding function to each
         one of them.
+
+        If a cache is given the rendered blocks are stored in it,
+        so only the blocks that changed are rendered again.
+
+        If a timeout in seconds is given, TextileTimeout is raised
+        when it runs out. The time is checked between blocks, between
+        the inline rules and between their matches, so only a single
+        regular expression search can overrun it. That is quadratic on
+        some inputs, so the size of the text has to be limited too.
+
+        If profile is set, the time spent in each phase is added
+        to the module level stats.
         """
+        if timeout is not None:
+            self.deadline = time.time() + timeout
+
+        self.profile = profile
+
         # Basic global changes.
-        self.preprocess()
+        self.timed('preprocess', len(self.text), self.preprocess)
 
         # Grab lookup links and clean them from the text.
-        self._links = self.grab_links()
+        self._links = self.timed('grab_links', len(self.text), self.grab_links)
 
         # Offset for the headers.
         self.head_offset = head_offset
 
         # Process each block.
-        self.blocks = self.split_text()
+        self.blocks = self.timed('split_text', len(self.text), self.split_text)
 
-        text = []
-        for [function, captures] in self.blocks:
-            text.append(function(**captures))
+        text = self.render_blocks(self.blocks, cache)
 
         text = '\n\n'.join(text)
 
         # Add titles to footnotes.
-        text = self.footnotes(text)
+        text = self.timed('footnotes', len(text), self.footnotes, text)
 
         # Convert to desired output.
         #TEH#text = unicode(text, encoding)
-        text = text.encode(output, 'xmlcharrefreplace')
+        text = self.timed('encode', len(text), text.encode, output, 'xmlcharrefreplace')
 
         # Sanitize?
         if sanitize:
-            p = _HTMLSanitizer()
-            p.feed(text)
-            text = p.output()
+            text = self.timed('sanitize', len(text), _sanitize, text)
 
         # Validate output.
         if _tidy and validate:
-            text = _tidy(text)
+            text = self.timed('validate', len(text), _tidy, text)
+
+        return text
+
+
+    def timed(self, phase, size, function, *args):
+        """Call the function, recording its time in stats if profiling."""
+        if not self.profile:
+            return function(*args)
+
+        start = time.time()
+        result = function(*args)
+        stats.record(phase, time.time() - start, size)
+
+        return result
+
+
+    def render_blocks(self, blocks, cache=None):
+        """Render the blocks, reusing cached output.
+
+        The cache should behave like memcache, providing get_multi()
+        and set_multi(). A block is keyed by its function and captures,
+        which include the extend and clear state, together with the
+        header offset and the link lookups of the whole text. The
+        footnote titles are added to the joined text afterwards, so
+        they are always resolved across the whole document.
+        """
+        if cache is None:
+            output = []
+            for function, captures in blocks:
+                self.check_deadline()
+                output.append(self.render_block(function, captures))
+            return output
+
+        links = sorted(self._links.items())
+        keys = []
+        for function, captures in blocks:
+            key = repr((function.__name__, sorted(captures.items()), self.head_offset, links))
+            keys.append(hashlib.md5(key).hexdigest())
+
+        cached = cache.get_multi(keys, key_prefix=BLOCK_CACHE_PREFIX)
+
+        output = []
+        rendered = {}
+        for key, (function, captures) in zip(keys, blocks):
+            if key in cached:
+                output.append(cached[key])
+            else:
+                self.check_deadline()
+                text = self.render_block(function, captures)
+                rendered[key] = text
+                output.append(text)
+
+        if rendered:
+            cache.set_multi(rendered, time=BLOCK_CACHE_TIME, key_prefix=BLOCK_CACHE_PREFIX)
+
+        return output
+
+
+    def render_block(self, function, captures):
+        """Apply the block function to its captures."""
+        if not self.profile:
+            return function(**captures)
+
+        start = time.time()
+        text = function(**captures)
+        stats.record('block:%s' % function.__name__, time.time() - start, len(captures.get('text') or ''))
 
         return text
 
 
+    def check_deadline(self):
+        """Give up if the render has run out of time."""
+        if self.deadline is not None and time.time() > self.deadline:
+            raise TextileTimeout('render took longer than its time budget')
+
+
     def sanitize(self, text):
         """Fix single tags.
 
@@ -2127,21 +2663,44 @@ class Textiler:
 
         are all valid acronyms.
         """
-        # Find the acronyms.
-        acronyms = r'''(?P<acronym>[\w]+)\((?P<definition>[^\(\)]+?)\)'''
+        text = self.define_acronyms(text)
+
+        segments = self.caps(_split_tags(text))
+
+        return ''.join(segments)
 
+
+    def define_acronyms(self, text):
+        """Replace acronyms followed by their definition with <acronym>."""
         # Check all acronyms.
-        for acronym, definition in re.findall(acronyms, text):
-            caps_acronym = ''.join(re.findall('[A-Z\d]+', acronym))
-            caps_definition = ''.join(re.findall('[A-Z\d]+', definition))
+        for acronym, definition in _acronym.findall(text):
+            caps_acronym = ''.join(_capitals.findall(acronym))
+            caps_definition = ''.join(_capitals.findall(definition))
             if caps_acronym and caps_acronym == caps_definition:
                 text = text.replace('%s(%s)' % (acronym, definition), '<acronym title="%s">%s</acronym>' % (definition, acronym))
-        
-        text = html_replace(r'''(^|\s)([A-Z]{3,})\b(?!\()''', r'''\1<span class="caps">\2</span>''', text)
 
         return text
 
 
+    def caps(self, segments):
+        """Add span tags to upper-case words in a text split at the HTML tags.
+
+        Returns the segments, with the new <span> tags split out
+        so they can be used for the glyphs.
+        """
+        output = []
+        for i, segment in enumerate(segments):
+            if not i % 2:
+                capped = preg_replace(_caps, r'''\1<span class="caps">\2</span>''', segment)
+                if capped != segment:
+                    output.extend(_split_tags(capped))
+                    continue
+
+            output.append(segment)
+
+        return output
+
+
     def footnotes(self, text):
         """Add titles to footnotes references.
 
@@ -2391,88 +2950,38 @@ class Textiler:
         * Convert ==(TM)==, ==(R)==, and  ==(C)== to &#8482;, &#174;, and &#169;.
         * Convert the letter x to a dimension sign: 2==x==4 to 2x4 and 8 ==x== 10 to 8x10.
         """
-        glyphs = [(r'''"(?<!\w)\b''', r'''&#8220;'''),                              # double quotes
-                  (r'''"''', r'''&#8221;'''),                                       # double quotes
-                  (r"""\b'""", r'''&#8217;'''),                                     # single quotes
-                  (r"""'(?<!\w)\b""", r'''&#8216;'''),                              # single quotes
-                  (r"""'""", r'''&#8217;'''),                                       # single single quote
-                  (r'''(\b|^)( )?\.{3}''', r'''\1&#8230;'''),                       # ellipsis
-                  (r'''\b---\b''', r'''&#8212;&#8212;'''),                          # double em dash
-                  (r'''\s?--\s?''', r'''&#8212;'''),                                # em dash
-                  (r'''(\d+)-(\d+)''', r'''\1&#8211;\2'''),                         # en dash (1954-1999)
-                  (r'''(\d+)-(\W)''', r'''\1&#8212;\2'''),                          # em dash (1954--)
-                  (r'''\s-\s''', r''' &#8211; '''),                                 # en dash
-                  (r'''(\d+) ?x ?(\d+)''', r'''\1&#215;\2'''),                      # dimension sign
-                  (r'''\b ?(\((tm|TM)\))''', r'''&#8482;'''),                       # trademark
-                  (r'''\b ?(\([rR]\))''', r'''&#174;'''),                           # registered
-                  (r'''\b ?(\([cC]\))''', r'''&#169;'''),                           # copyright
-                  (r'''([^\s])\[(\d+)\]''',                                         #
-                       r'''\1<sup class="footnote"><a href="#fn\2">\2</a></sup>'''),# footnote
-                  ]
-
         # Apply macros.
-        text = re.sub(r'''{([^}]+)}''', self.macros, text)
+        text = _macro.sub(self.macros, text)
 
         # LaTeX style quotes.
         #TEH#text = text.replace('\x60\x60', '&#8220;')
         #TEH#text = text.replace('\xb4\xb4', '&#8221;')
 
-        # Linkify URL and emails.
-        url = r'''(?=[a-zA-Z0-9./#])                          # Must start correctly
-                  ((?:                                        # Match the leading part (proto://hostname, or just hostname)
-                      (?:ftp|https?|telnet|nntp)              #     protocol
-                      ://                                     #     ://
-                      (?:                                     #     Optional 'username:password@'
-                          \w+                                 #         username
-                          (?::\w+)?                           #         optional :password
-                          @                                   #         @
-                      )?                                      # 
-                      [-\w]+(?:\.\w[-\w]*)+                   #     hostname (sub.example.com)
-                  )                                           #
-                  (?::\d+)?                                   # Optional port number
-                  (?:                                         # Rest of the URL, optional
-                      /?                                      #     Start with '/'
-                      [^.!,?;:"'<>()\[\]{}\s\x7F-\xFF]*       #     Can't start with these
-                      (?:                                     #
-                          [.!,?;:]+                           #     One or more of these
-                          [^.!,?;:"'<>()\[\]{}\s\x7F-\xFF]+   #     Can't finish with these
-                          #'"                                 #     # or ' or "
-                      )*                                      #
-                  )?)                                         #
-               '''
-
-        email = r'''(?:mailto:)?            # Optional mailto:
-                    ([-\+\w]+               # username
-                    \@                      # at
-                    [-\w]+(?:\.\w[-\w]*)+)  # hostname
-                 '''
-
-        # If there is no html, do a simple search and replace.
-        if not re.search(r'''<.*>''', text):
-            for glyph_search, glyph_replace in glyphs:
-                text = preg_replace(glyph_search, glyph_replace, text)
+        segments = _split_tags(text)
+        self.glyph_segments(segments)
 
-            # Linkify.
-            text = re.sub(re.compile(url, re.VERBOSE), r'''<a href="\1">\1</a>''', text)
-            text = re.sub(re.compile(email, re.VERBOSE), r'''<a href="mailto:\1">\1</a>''', text)
+        return ''.join(segments)
 
-        else:
-            lines = []
-            # Else split the text into an array at <>.
-            for line in re.split('(<.*?>)', text):
-                if not re.match('<.*?>', line):
-                    for glyph_search, glyph_replace in glyphs:
-                        line = preg_replace(glyph_search, glyph_replace, line)
 
-                    # Linkify.
-                    line = re.sub(re.compile(url, re.VERBOSE), r'''<a href="\1">\1</a>''', line)
-                    line = re.sub(re.compile(email, re.VERBOSE), r'''<a href="mailto:\1">\1</a>''', line)
+    def glyph_segments(self, segments):
+        """Apply the glyphs to a text split at the HTML tags.
 
-                lines.append(line)
+        The segments come from _split_tags(), and are changed in place.
+        Only the text segments are formatted, leaving the tags alone.
+        """
+        for i in range(0, len(segments), 2):
+            segment = segments[i]
+            for glyph_search, glyph_replace in _glyphs:
+                self.check_deadline()
+                segment = preg_replace(glyph_search, glyph_replace, segment)
 
-            text = ''.join(lines)
+            # Linkify.
+            self.check_deadline()
+            segment = _linkify_url.sub(r'''<a href="\1">\1</a>''', segment)
+            self.check_deadline()
+            segment = _linkify_email.sub(r'''<a href="mailto:\1">\1</a>''', segment)
 
-        return text
+            segments[i] = segment
 
 
     def qtags(self, text):
@@ -2511,56 +3020,17 @@ class Textiler:
         (class) or (#id) or (class#id):For CSS(Cascading Style Sheets) class and id attributes. 
         """
         # itex2mml.
-        text = re.sub('\$(.*?)\$', lambda m: self.itex(m.group()), text)
+        text = _itex.sub(lambda m: self.itex(m.group()), text)
 
         # Add span tags to upper-case words which don't have a description.
         #text = preg_replace(r'''(^|\s)([A-Z]{3,})\b(?!\()''', r'''\1<span class="caps">\2</span>''', text)
         
-        # Quick tags.
-        qtags = [('**', 'b',      {'qf': '(?<!\*)\*\*(?!\*)', 'cls': '\*'}),
-                 ('__', 'i',      {'qf': '(?<!_)__(?!_)', 'cls': '_'}),
-                 ('??', 'cite',   {'qf': '\?\?(?!\?)', 'cls': '\?'}),
-                 ('-',  'del',    {'qf': '(?<!\-)\-(?!\-)', 'cls': '-'}),
-                 ('+',  'ins',    {'qf': '(?<!\+)\+(?!\+)', 'cls': '\+'}),
-                 ('*',  'strong', {'qf': '(?<!\*)\*(?!\*)', 'cls': '\*'}),
-                 ('_',  'em',     {'qf': '(?<!_)_(?!_)', 'cls': '_'}),
-                 ('++', 'big',    {'qf': '(?<!\+)\+\+(?!\+)', 'cls': '\+\+'}),
-                 ('--', 'small',  {'qf': '(?<!\-)\-\-(?!\-)', 'cls': '\-\-'}),
-                 ('~',  'sub',    {'qf': '(?<!\~)\~(?!(\\\/~))', 'cls': '\~'}),
-                 ('@',  'code',   {'qf': '(?<!@)@(?!@)', 'cls': '@'}),
-                 ('%',  'span',   {'qf': '(?<!%)%(?!%)', 'cls': '%'}),
-                ]
-
         # Superscript.
-        text = re.sub(r'''(?<!\^)\^(?!\^)(.+?)(?<!\^)\^(?!\^)''', r'''<sup>\1</sup>''', text)
-
-        # This is from the perl version of Textile.
-        for qtag, htmltag, redict in qtags:
-            self.res.update(redict)
-            p = re.compile(r'''(?:                          #
-                                   ^                        # Start of string
-                                   |                        #
-                                   (?<=[\s>'"])             # Whitespace, end of tag, quotes
-                                   |                        #
-                                   (?P<pre>[{[])            # Surrounded by [ or {
-                                   |                        #
-                                   (?<=%(punct)s)           # Punctuation
-                               )                            #
-                               %(qf)s                       # opening tag
-                               %(qattr)s                    # attributes
-                               (?P<text>[^%(cls)s\s].*?)    # text
-                               (?<=\S)                      # non-whitespace
-                               %(qf)s                       # 
-                               (?:                          #
-                                   $                        # End of string
-                                   |                        #
-                                   (?P<post>[\]}])          # Surrounded by ] or }
-                                   |                        # 
-                                   (?=%(punct)s{1,2}|\s)    # punctuation
-                                )                           #
-                             ''' % self.res, re.VERBOSE)
+        text = _superscript.sub(r'''<sup>\1</sup>''', text)
 
+        for htmltag, p in _qtags:
             def _replace(m):
+                self.check_deadline()
                 c = m.groupdict('')
 
                 attributes = self.parse_params(c['parameters'])
@@ -2574,6 +3044,7 @@ class Textiler:
          
                 return open_tag + c['text'] + close_tag
 
+            self.check_deadline()
             text = p.sub(_replace, text)
 
         return text
@@ -2634,28 +3105,7 @@ class Textiler:
         Images receive the class "top" when using top alignment, "bottom" 
         for bottom alignment and "middle" for middle alignment.
         """
-        # Compile the beast.
-        p = re.compile(r'''\!               # Opening !
-                           %(iattr)s        # Image attributes
-                           (?P<src>%(url)s) # Image src
-                           \s?              # Optional whitesapce
-                           (                #
-                               \(           #
-                               (?P<alt>.*?) # Optional (alt) attribute
-                               \)           #
-                           )?               #
-                           \s?              # Optional whitespace
-                           %(resize)s       # Resize parameters
-                           \!               # Closing !
-                           (                # Optional link
-                               :            #    starts with ':'
-                               (?P<link>    #    
-                               %(url)s      #    link HREF
-                               )            #
-                           )?               #
-                        ''' % self.res, re.VERBOSE)
-
-        for m in p.finditer(text):
+        for m in _image.finditer(text):
             c = m.groupdict('')
 
             # Build the parameters for the <img /> tag.
@@ -2752,30 +3202,9 @@ class Textiler:
         <a href="http://www.google.com/search?q=PyBlosxom">PyBlosxom</a>
         <a href="http://www.google.com/search?q=python+blosxom+textile">Using Textile and Blosxom with Python</a>
         """
-        linkres = [r'''\[                           # [
-                       (?P<quote>"|')               # Opening quotes
-                       %(lattr)s                    # Link attributes
-                       (?P<text>[^"]+?)             # Link text
-                       \s?                          # Optional whitespace
-                       (?:\((?P<title>[^\)]+?)\))?  # Optional (title)
-                       (?P=quote)                   # Closing quotes
-                       :                            # :
-                       (?P<href>[^\]]+)             # HREF
-                       \]                           # ]
-                    ''' % self.res,
-                   r'''(?P<quote>"|')               # Opening quotes
-                       %(lattr)s                    # Link attributes
-                       (?P<text>[^"]+?)             # Link text
-                       \s?                          # Optional whitespace
-                       (?:\((?P<title>[^\)]+?)\))?  # Optional (title)
-                       (?P=quote)                   # Closing quotes
-                       :                            # :
-                       (?P<href>%(url)s)            # HREF
-                    ''' % self.res]
-
-        for linkre in linkres:
-            p = re.compile(linkre, re.VERBOSE)
+        for p in _links:
             for m in p.finditer(text):
+                self.check_deadline()
                 c = m.groupdict('')
 
                 attributes = self.parse_params(c['parameters'])
@@ -2817,13 +3246,33 @@ class Textiler:
         This function basically defines the order on which the 
         formatting is applied.
         """
+        self.check_deadline()
         text = self.qtags(text)
+        self.check_deadline()
         text = self.images(text)
+        self.check_deadline()
         text = self.links(text)
-        text = self.acronym(text)
-        text = self.glyphs(text)
+        self.check_deadline()
 
-        return text
+        # The acronyms and glyphs share the split of the text at the
+        # HTML tags, instead of splitting it for each of them.
+        text = self.define_acronyms(text)
+        segments = self.caps(_split_tags(text))
+        self.check_deadline()
+
+        # Macros can replace a stray < or >, so if any were applied
+        # the text is split again.
+        if '{' in text:
+            text = ''.join(segments)
+            macros = _macro.sub(self.macros, text)
+            self.check_deadline()
+            if macros != text:
+                segments = _split_tags(macros)
+
+        self.glyph_segments(segments)
+        self.check_deadline()
+
+        return ''.join(segments)
 
 
     def inline(self, text):
@@ -2864,7 +3313,8 @@ def textile(text, **args):
     This function should be called like this:
     
         textile(text, head_offset=0, validate=0, sanitize=0,
-                encoding='latin-1', output='ASCII')
+                encoding='latin-1', output='ASCII', cache=None,
+                timeout=None, profile=0)
     """
     return Textiler(text).process(**args)
 
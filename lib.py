@@ -1,17 +1,24 @@
 import os
 import re
+import cgi
 import logging
 import unicodedata
 import sys
+import time
+import types
 import traceback
+from datetime import datetime
 
 from google.appengine.api import memcache
+from google.appengine.ext import db
 from google.appengine.ext import webapp
 from google.appengine.ext.webapp import template
 from google.appengine.api import users
+from django.utils import simplejson
 
 import settings
-from ext.textile import textile as real_textile
+from ext.textile import textile as real_textile, TextileTimeout, TextileStats
+from ext.textile import stats as textile_stats
 
 def slugify(value):
     "Slugify a string, to make it URL friendly."
@@ -23,9 +30,255 @@ def slugify(value):
 
 def textile(value):
     "Stub for adding textile functionality"
-    value = real_textile(value, sanitize=1)
+    # very large descriptions aren't rendered at all as
+    # some inputs make the textile regexes very slow
+    if len(value) > settings.TEXTILE_MAX_SIZE:
+        return textile_fallback(value, "too large")
+
+    # rendered blocks are cached so an edit only renders
+    # the blocks that have changed
+    if settings.CACHE:
+        cache = memcache
+    else:
+        cache = None
+    try:
+        value = real_textile(value, sanitize=1, cache=cache,
+            timeout=settings.TEXTILE_TIMEOUT, profile=settings.TEXTILE_PROFILE)
+    except TextileTimeout:
+        return textile_fallback(value, "timed out")
+
+    # the profile is kept per instance, so add it to the
+    # shared totals every minute or so
+    if settings.TEXTILE_PROFILE and time.time() - textile_stats.started > 60:
+        save_textile_stats()
     return value
 
+def save_textile_stats():
+    "Add the textile profile of this instance to the totals in memcache"
+    totals = get_textile_stats()
+    totals.merge(textile_stats.phases)
+    memcache.set("textile_stats", totals.phases)
+    textile_stats.reset()
+
+def get_textile_stats():
+    "The textile profile totals from all the instances"
+    totals = TextileStats()
+    totals.merge(memcache.get("textile_stats") or {})
+    return totals
+
+def textile_fallback(value, reason):
+    "Plain text version of a description we couldn't render"
+    logging.warning("textile render %s, %d characters shown as text" % (reason, len(value)))
+    # count these so they can be reviewed from the admin page
+    memcache.incr("textile_fallbacks", initial_value=0)
+    output = "<pre>%s</pre>" % cgi.escape(value)
+    return output.encode('ascii', 'xmlcharrefreplace')
+
+def get_limit(value, default, maximum):
+    "Number of items asked for in the query string, kept within bounds"
+    try:
+        limit = int(value)
+    except ValueError:
+        return default
+    return max(1, min(limit, maximum))
+
+RANGE_RE = re.compile(r'^bytes=(\d*)-(\d*)$')
+
+def parse_range(header, size):
+    """
+    First and last byte asked for by a Range header, or None to send the
+    whole file. Only a single range is supported, anything else is ignored
+    as HTTP allows. Raises ValueError if the range is outside the file
+    """
+    match = RANGE_RE.match((header or '').replace(' ', ''))
+    if not match or match.groups() == ('', ''):
+        return None
+    if size == 0:
+        raise ValueError("empty file")
+    first, last = match.groups()
+    if not first:
+        # the final so many bytes
+        if int(last) == 0:
+            raise ValueError("empty range")
+        return max(size - int(last), 0), size - 1
+    first = int(first)
+    if last and int(last) < first:
+        return None
+    if first >= size:
+        raise ValueError("range starts after the end of the file")
+    if last:
+        return first, min(int(last), size - 1)
+    return first, size - 1
+
+def etag_matches(header, etag):
+    """
+    Whether an If-None-Match header matches the ETag. This is the weak
+    comparison, as proxies often weaken the ETag when they compress a
+    response. If-Range needs the strong one, so it isn't checked here
+    """
+    if not header:
+        return False
+    tags = [re.sub('^W/', '', tag.strip()) for tag in header.split(',')]
+    return re.sub('^W/', '', etag) in tags or '*' in tags
+
+def read_multipart(stream, boundary, block_size=65536):
+    """
+    Parse a multipart/form-data body a block at a time rather than all
+    in memory. Yields ('part', headers) at the start of each part, with
+    the header names in lower case, then ('data', string) for pieces of
+    its content. Raises ValueError if the body ends before the final
+    boundary
+    """
+    delimiter = '\r\n--' + boundary
+    # the first boundary isn't after a line break, so add one
+    buffer = '\r\n'
+    in_part = False
+    in_headers = False
+    finished = False
+    while not finished:
+        block = stream.read(block_size)
+        buffer += block
+        while True:
+            if in_headers:
+                end = buffer.find('\r\n\r\n')
+                if end < 0:
+                    break
+                headers = {}
+                for line in buffer[:end].split('\r\n'):
+                    if ':' in line:
+                        name, value = line.split(':', 1)
+                        headers[name.strip().lower()] = value.strip()
+                yield 'part', headers
+                buffer = buffer[end + 4:]
+                in_headers = False
+                in_part = True
+
+            index = buffer.find(delimiter)
+            if index < 0:
+                # keep enough to find a delimiter split between blocks
+                keep = len(delimiter) - 1
+                if len(buffer) > keep:
+                    if in_part:
+                        yield 'data', buffer[:-keep]
+                    buffer = buffer[-keep:]
+                break
+
+            if in_part and index:
+                yield 'data', buffer[:index]
+            buffer = buffer[index:]
+            rest = buffer[len(delimiter):]
+            if rest.startswith('--'):
+                finished = True
+                break
+            end_of_line = rest.find('\r\n')
+            if end_of_line < 0:
+                # wait for the rest of the boundary line
+                in_part = False
+                break
+            buffer = rest[end_of_line + 2:]
+            in_part = False
+            in_headers = True
+
+        if not block and not finished:
+            raise ValueError("multipart body ended early")
+
+def batches(query, size):
+    "Iterate over a query a batch at a time, fetched with cursors"
+    while True:
+        batch = query.fetch(size)
+        if batch:
+            yield batch
+        if len(batch) < size:
+            return
+        query.with_cursor(query.cursor())
+
+def slices(items, size):
+    "Split a list into lists of at most size items"
+    return [items[start:start + size] for start in range(0, len(items), size)]
+
+def get_in_batches(keys):
+    "db.get of any number of keys, in calls within the datastore's limit"
+    entities = []
+    for batch in slices(keys, settings.DATASTORE_BATCH_SIZE):
+        entities.extend(db.get(batch))
+    return entities
+
+def put_in_batches(entities):
+    """
+    db.put of any number of entities, in calls within the datastore's
+    limits on the number of entities and the size of a call
+    """
+    batch = []
+    size = 0
+    for entity in entities:
+        entity_size = db.model_to_protobuf(entity).ByteSize()
+        if batch and (len(batch) == settings.DATASTORE_BATCH_SIZE
+                or size + entity_size > settings.DATASTORE_BATCH_BYTES):
+            db.put(batch)
+            batch = []
+            size = 0
+        batch.append(entity)
+        size += entity_size
+    if batch:
+        db.put(batch)
+
+class RawJson(str):
+    "JSON which is already encoded, written as it is by write_json_object"
+
+def write_json_object(out, members):
+    """
+    Write a JSON object to out a member at a time, rather than encoding
+    it all in memory. members is a list or iterator of (key, value) pairs
+    and a value which is a generator of pairs is written as an object
+    in the same way. The output is what simplejson.dumps would produce,
+    with RawJson values written as they are
+    """
+    out.write('{')
+    separator = ''
+    for key, value in members:
+        out.write(separator)
+        out.write(simplejson.dumps(key))
+        out.write(': ')
+        if isinstance(value, types.GeneratorType):
+            write_json_object(out, value)
+        elif isinstance(value, RawJson):
+            out.write(value)
+        else:
+            out.write(simplejson.dumps(value))
+        separator = ', '
+    out.write('}')
+
+def parse_date(value):
+    "Parse a date in the format used by the JSON API, 2010-01-31 12:00:00"
+    return datetime.strptime(value.replace('T', ' ')[:19], "%Y-%m-%d %H:%M:%S")
+
+class BoundedTee(object):
+    """
+    File like object which passes everything written on to another
+    file, keeping a copy as long as it stays under the size limit
+    """
+    def __init__(self, out, limit):
+        self.out = out
+        self.limit = limit
+        self.size = 0
+        self.parts = []
+
+    def write(self, data):
+        self.out.write(data)
+        if self.parts is not None:
+            self.size += len(data)
+            if self.size > self.limit:
+                # too big to keep, so stop copying
+                self.parts = None
+            else:
+                self.parts.append(data)
+
+    def getvalue(self):
+        "Everything written, or None if it went over the limit"
+        if self.parts is None:
+            return None
+        return ''.join(self.parts)
+
 class BaseRequest(webapp.RequestHandler):
     "Extended request object with extra functionality"
     
@@ -2,6 +2,8 @@
 
 import re
 import os
+import cgi
+import urllib
 import logging
 from datetime import datetime
 
@@ -11,19 +13,20 @@ from google.appengine.ext import webapp
 from google.appengine.api import users
 from google.appengine.ext.webapp.util import run_wsgi_app
 from google.appengine.api import mail
+from google.appengine.api import taskqueue
 
 from django.utils import simplejson
 
-from lib import BaseRequest, get_cache, slugify
+from lib import BaseRequest, BoundedTee, get_cache, get_limit, slugify
+from lib import batches, write_json_object, parse_date, RawJson
+from lib import parse_range, etag_matches, read_multipart
 import settings
-from models import Project, Issue, DatastoreFile
-from ext.PyRSS2Gen import RSS2, RSSItem
+from models import Project, Issue, Event, DatastoreFile, BlobWriter, WebHookPayload
+from models import queue_migrations
+from ext.PyRSS2Gen import RSS2, RSSItem, RawXml, Guid
 
 webapp.template.register_template_library('tags.filters')
 
-# regex for the patter to look for in the webhooks
-GITBUG = re.compile('#gitbug[0-9]+')
-
 # validate url
 URL_RE = re.compile(
     r'^https?://' # http:// or https://
@@ -34,6 +37,154 @@ URL_RE = re.compile(
     r'(?:/?|/\S+)$', re.IGNORECASE)
 
 
+def page_url(url, params):
+    "URL of a page of a feed with its query string arguments"
+    params = [(key, value) for key, value in sorted(params.items()) if value]
+    if not params:
+        return url
+    return "%s?%s" % (url, urllib.urlencode(params))
+
+class PagedRSS2(RSS2):
+    "RSS feed with RFC 5005 links to the other pages of the feed"
+    rss_attrs = {"version": "2.0", "xmlns:atom": "http://www.w3.org/2005/Atom"}
+
+    def __init__(self, pages, **kwargs):
+        # pages is a list of (rel, href) pairs
+        RSS2.__init__(self, **kwargs)
+        self.pages = pages
+
+    def publish_extensions(self, handler):
+        for rel, href in self.pages:
+            handler.startElement("atom:link", {
+                "rel": rel,
+                "href": href,
+                "type": "application/rss+xml",
+            })
+            handler.endElement("atom:link")
+
+def issue_rss_item(issue):
+    "RSS item for an issue"
+    if issue.fixed: 
+        pubDate = issue.fixed_date
+        title = "%s (%s)" % (issue.name, "Fixed")
+    else:
+        pubDate = issue.created_date
+        title = issue.name
+
+    return RSSItem(
+        title=title,
+        link="%s/projects%s" % (settings.SYSTEM_URL, issue.internal_url),
+        description=issue.description_html,
+        pubDate=pubDate
+    )
+
+def issue_rss_items(issues):
+    """
+    RSS items for the issues. The XML of each item is cached by issue
+    and modified date, so it's shared by the open, closed and full
+    feeds and only made again when the issue is saved
+    """
+    keys = ["%s/%s" % (issue.key(), issue.modified_date) for issue in issues]
+    cached = {}
+    if settings.CACHE:
+        cached = memcache.get_multi(keys, key_prefix="rss_item/")
+
+    created = {}
+    for key, issue in zip(keys, issues):
+        xml = cached.get(key)
+        if xml is None:
+            xml = issue_rss_item(issue).xml_fragment()
+            created[key] = xml
+        yield RawXml(xml)
+
+    if created and settings.CACHE:
+        memcache.set_multi(created, time=86400, key_prefix="rss_item/")
+
+def issue_json(project, issue):
+    "JSON data for an issue"
+    # friendlier display of information
+    if issue.fixed: 
+        status = "Fixed"
+    else:
+        status = "Open"
+
+    # set structure of inner json
+    data = {
+        'internal_url': "%s/projects%s" % (settings.SYSTEM_URL, issue.internal_url),
+        'created_date': str(project.created_date)[0:19],
+        'description': issue.description_html,
+        'status': status,
+        'identifier': "#gitbug%s" % issue.identifier,
+    }
+    if issue.fixed and issue.fixed_description:
+        data['fixed_description'] = issue.fixed_description
+    return data
+
+def issue_json_members(project, issue_batches):
+    """
+    Name and encoded JSON of each issue, a batch of issues at a time.
+    The JSON is cached by issue and modified date, so only the issues
+    saved since the last time are encoded again
+    """
+    for issues in issue_batches:
+        keys = ["%s/%s" % (issue.key(), issue.modified_date) for issue in issues]
+        cached = {}
+        if settings.CACHE:
+            cached = memcache.get_multi(keys, key_prefix="json_item/")
+
+        created = {}
+        for key, issue in zip(keys, issues):
+            json = cached.get(key)
+            if json is None:
+                json = simplejson.dumps(issue_json(project, issue))
+                created[key] = json
+            yield issue.name, RawJson(json)
+
+        if created and settings.CACHE:
+            memcache.set_multi(created, time=86400, key_prefix="json_item/")
+
+def project_rss_items(projects):
+    "RSS items for the projects, created as the query is iterated"
+    for project in projects:
+        yield RSSItem(
+            title=project.name,
+            link="%s/projects/%s/" % (settings.SYSTEM_URL, project.slug),
+            description="",
+            pubDate=project.created_date
+        )
+
+def event_rss_item(event):
+    "RSS item for an event in the activity feed"
+    if event.action == "deleted":
+        link = "%s/projects/%s/" % (settings.SYSTEM_URL, event.project_slug)
+    else:
+        link = "%s/projects%s" % (settings.SYSTEM_URL, event.internal_url)
+    title = "%s %s in %s" % (event.issue_name, event.action, event.project_name)
+    if event.source == "webhook":
+        title = "%s by a commit" % title
+    return RSSItem(
+        title=title,
+        link=link,
+        description="",
+        guid=Guid("%s/activity/%s" % (settings.SYSTEM_URL, event.key().id()), isPermaLink=0),
+        pubDate=event.created_date
+    )
+
+def event_json(event):
+    "JSON data for an event in the activity feed"
+    data = {
+        'action': event.action,
+        'source': event.source,
+        'date': str(event.created_date)[0:19],
+        'name': event.issue_name,
+        'project': event.project_name,
+        'project_url': "%s/projects/%s/" % (settings.SYSTEM_URL, event.project_slug),
+        'identifier': "#gitbug%s" % event.identifier,
+    }
+    if event.action != "deleted":
+        data['internal_url'] = "%s/projects%s" % (settings.SYSTEM_URL, event.internal_url)
+    return data
+
 class Index(BaseRequest):
     "Home page. Shows either introductory info or a list of the users projects"
     def get(self):
@@ -72,12 +223,12 @@ class ProjectHandler(BaseRequest):
             try:
                 project = Project.all().filter('slug =', slug).fetch(1)[0]        
                 issues = Issue.all().filter('project =', project)
+                # only the file details, the data is kept in blobs
                 files = DatastoreFile.all().filter('project =', project)
             except IndexError:
                 self.render_404()
                 return 
                 
-            logging.info("Files in this project: %d" % files.count())
             # check to see if we have admin rights over this project
             if project.user == user or users.is_current_user_admin():
                 owner = True
@@ -117,6 +268,7 @@ class ProjectHandler(BaseRequest):
                 if email:
                     issue.email = email
                 issue.put()
+                Event.record("created", issue)
                 mail.send_mail(sender="prokontrol@gmail.com",
                     to=project.user.email(),
                     subject="[GitBug] New bug added to %s" % project.name,
@@ -136,48 +288,94 @@ Thanks for using GitBug <http://gitbug.appspot.com>. A very simple issue tracker
 class ProjectJsonHandler(BaseRequest):
     "Project information in JSON"
     def get(self, slug):
-        output = get_cache("project_%s_json" % slug)
+        # without paging arguments we send every issue
+        params = {
+            'limit': self.request.get("limit"),
+            'cursor': self.request.get("cursor"),
+            'since': self.request.get("since"),
+        }
+        if [value for value in params.values() if value]:
+            self.get_page(slug, params)
+            return
+
+        key = "project_%s_json" % slug
+        output = get_cache(key)
         if output is None:
             project = Project.all().filter('slug =', slug).fetch(1)[0]        
             issues = Issue.all().filter('project =', project).order('fixed').order('created_date')
+            # the issues are fetched and written out a batch at a time
+            self.write_project(project, batches(issues, 100), [], key, 3600)
+        else:
+            self.write_cached(output)
+
+    def get_page(self, slug, params):
+        """
+        A page of the issues in order of when they were last changed,
+        optionally only those changed since a given date
+        """
+        key = "project_%s_json_%s" % (slug, page_url("", params))
+        output = get_cache(key)
+        if output is None:
+            try:
+                project = Project.all().filter('slug =', slug).fetch(1)[0]        
+            except IndexError:
+                self.render_404()
+                return
 
-            issues_data = {}
-            for issue in issues:
-                # friendlier display of information
-                if issue.fixed: 
-                    status = "Fixed"
-                else:
-                    status = "Open"
-
-                # set structure of inner json
-                data = {
-                    'internal_url': "%s/projects%s" % (settings.SYSTEM_URL, issue.internal_url),
-                    'created_date': str(project.created_date)[0:19],
-                    'description': issue.html,
-                    'status': status,
-                    'identifier': "#gitbug%s" % issue.identifier,
-                }
-                if issue.fixed and issue.fixed_description:
-                    data['fixed_description'] = issue.fixed_description
-                issues_data[issue.name] = data
+            limit = get_limit(params['limit'], settings.JSON_LIMIT, settings.JSON_MAX_LIMIT)
+            issues = Issue.all().filter('project =', project).order('modified_date')
+            try:
+                if params['since']:
+                    issues.filter('modified_date >', parse_date(params['since']))
+                if params['cursor']:
+                    issues.with_cursor(params['cursor'])
+                page = issues.fetch(limit)
+            except (ValueError, db.BadValueError, db.BadRequestError):
+                # a date or cursor we can't use
+                self.error(400)
+                return
 
-            # set structure of outer json
-            json = {
-                'date': str(datetime.now())[0:19],
-                'name': project.name,
-                'internal_url': "%s/projects/%s/" % (settings.SYSTEM_URL, project.slug),
-                'created_date': str(project.created_date)[0:19],
-                'issues': issues_data,
-            }
-            
-            if project.url:
-                json['external_url'] = project.url
+            # link to the rest of the issues if there might be more
+            members = []
+            if len(page) == limit:
+                url = "%s/projects/%s.json" % (settings.SYSTEM_URL, project.slug)
+                cursor = issues.cursor()
+                members.append(('cursor', cursor))
+                members.append(('next', page_url(url, dict(params, cursor=cursor))))
+
+            # pollers want to see changes quickly, so these
+            # are only cached for a short time
+            self.write_project(project, [page], members, key, 60)
+        else:
+            self.write_cached(output)
+
+    def write_project(self, project, issue_batches, members, key, cache_time):
+        """
+        Write the project with the issues in the batches, and any other
+        members before them. The json goes straight to the response,
+        keeping a copy in the cache under the key if it isn't too big
+        """
+        json = [
+            ('date', str(datetime.now())[0:19]),
+            ('name', project.name),
+            ('internal_url', "%s/projects/%s/" % (settings.SYSTEM_URL, project.slug)),
+            ('created_date', str(project.created_date)[0:19]),
+        ]
+        if project.url:
+            json.append(('external_url', project.url))
+        json.extend(members)
+        json.append(('issues', issue_json_members(project, issue_batches)))
 
-            # create the json
-            output = simplejson.dumps(json)
-            # cache it
-            memcache.add("project_%s_json" % slug, output, 3600)
-        # send the correct headers
+        self.response.headers["Content-Type"] = "application/javascript; charset=utf8"
+        out = BoundedTee(self.response.out, settings.FEED_CACHE_SIZE)
+        write_json_object(out, json)
+
+        output = out.getvalue()
+        if output is not None:
+            memcache.add(key, output, cache_time)
+
+    def write_cached(self, output):
+        "Write the json saved by write_project"
         self.response.headers["Content-Type"] = "application/javascript; charset=utf8"
         self.response.out.write(output)
         
@@ -185,59 +383,79 @@ class ProjectRssHandler(BaseRequest):
     "Project as RSS, specifically lists issues"
     def get(self, slug):
 
-        output = get_cache("project_%s_rss" % slug)
+        # allow query string arguments to specify filters
+        params = {}
+        if self.request.get("open"):
+            params['open'] = 1
+        elif self.request.get("closed"):
+            params['closed'] = 1
+
+        # feeds are paged, with the most recently changed issues first
+        limit = get_limit(self.request.get("limit"), settings.FEED_LIMIT, settings.FEED_MAX_LIMIT)
+        if limit != settings.FEED_LIMIT:
+            params['limit'] = limit
+        cursor = self.request.get("cursor")
+
+        key = "project_%s_rss_%s" % (slug, page_url("", dict(params, cursor=cursor)))
+        output = get_cache(key)
         if output is None:
 
-            project = Project.all().filter('slug =', slug).fetch(1)[0]        
-               
-            # allow query string arguments to specify filters
-            if self.request.get("open"):
-                status_filter = True
-                fixed = False
-            elif self.request.get("closed"):
-                status_filter = True
-                fixed = True
-            else:
-                status_filter = None
+            try:
+                project = Project.all().filter('slug =', slug).fetch(1)[0]        
+            except IndexError:
+                self.render_404()
+                return
 
             # if we have a filter then filter the results set
-            if status_filter:
-                issues = Issue.all().filter('project =', project).filter('fixed =', fixed).order('fixed').order('created_date')
+            issues = Issue.all().filter('project =', project)
+            if 'open' in params:
+                issues.filter('fixed =', False)
+            elif 'closed' in params:
+                issues.filter('fixed =', True)
+            issues.order('-modified_date')
+
+            try:
+                if cursor:
+                    issues.with_cursor(cursor)
+                page = issues.fetch(limit)
+            except (db.BadValueError, db.BadRequestError):
+                # not a cursor we handed out
+                self.error(400)
+                return
+
+            # link to this page, the newest page and the older issues
+            url = "%s/projects/%s.rss" % (settings.SYSTEM_URL, project.slug)
+            if cursor:
+                current = page_url(url, dict(params, cursor=cursor))
             else:
-                issues = Issue.all().filter('project =', project).order('fixed').order('created_date')
-            
-            # create the RSS feed
-            rss = RSS2(
+                current = page_url(url, params)
+            pages = [("self", current), ("first", page_url(url, params))]
+            if len(page) == limit:
+                pages.append(("next", page_url(url, dict(params, cursor=issues.cursor()))))
+
+            # create the RSS feed, the items are created as
+            # they are written rather than all up front
+            rss = PagedRSS2(
+                pages,
                 title="Issues for %s on GitBug" % project.name,
                 link="%s/%s/" % (settings.SYSTEM_URL, project.slug),
                 description="",
-                lastBuildDate=datetime.now()
+                lastBuildDate=datetime.now(),
+                items=issue_rss_items(page)
             )
 
-            # add an item for each issue
-            for issue in issues:
-                if issue.fixed: 
-                    pubDate = issue.fixed_date
-                    title = "%s (%s)" % (issue.name, "Fixed")
-                else:
-                    pubDate = issue.created_date
-                    title = issue.name
-                
-                rss.items.append(
-                    RSSItem(
-                        title=title,
-                        link="%s/projects%s" % (settings.SYSTEM_URL, issue.internal_url),
-                        description=issue.html,
-                        pubDate=pubDate
-                    ))
-
-            # get the xml
-            output = rss.to_xml()
-
-            memcache.add("project_%s_rss" % slug, output, 3600)
-        # send the correct headers
-        self.response.headers["Content-Type"] = "application/rss+xml; charset=utf8"
-        self.response.out.write(output)
+            # write the xml straight to the response, keeping
+            # a copy for the cache if it isn't too big
+            self.response.headers["Content-Type"] = "application/rss+xml; charset=utf8"
+            out = BoundedTee(self.response.out, settings.FEED_CACHE_SIZE)
+            rss.write_xml(out)
+
+            output = out.getvalue()
+            if output is not None:
+                memcache.add(key, output, 3600)
+        else:
+            self.response.headers["Content-Type"] = "application/rss+xml; charset=utf8"
+            self.response.out.write(output)
 
 class ProjectDeleteHandler(BaseRequest):
     "Delete projects, including a confirmation page"
@@ -423,6 +641,7 @@ class IssueHandler(BaseRequest):
         if issue.project.user == user:
         
             try:
+                was_fixed = issue.fixed
                 name = self.request.get("name")
                 description = self.request.get("description")
                 email = self.request.get("email")
@@ -444,6 +663,12 @@ class IssueHandler(BaseRequest):
                     issue.fixed_description = None
     
                 issue.put()
+                if issue.fixed and not was_fixed:
+                    Event.record("fixed", issue)
+                elif was_fixed and not issue.fixed:
+                    Event.record("reopened", issue)
+                else:
+                    Event.record("edited", issue)
                 logging.info("issue edited: %s in %s" % (issue.name, issue.project.name))
                 
             except Exception, e:
@@ -471,7 +696,7 @@ class IssueJsonHandler(BaseRequest):
                 'project_url': "%s/projects/%s" % (settings.SYSTEM_URL, issue.project.slug),
                 'internal_url': "%s/projects/%s/" % (settings.SYSTEM_URL, issue.internal_url),
                 'created_date': str(issue.created_date)[0:19],
-                'description': issue.html,
+                'description': issue.description_html,
                 'status': status,
                 'identifier': "#gitbug%s" % issue.identifier,
             }
@@ -527,6 +752,7 @@ class IssueDeleteHandler(BaseRequest):
             try:
                 logging.info("deleted issue: %s in %s" % (issue.name, issue.project.name))
                 issue.delete()
+                Event.record("deleted", issue)
             except Exception, e:
                 logging.error("error deleting issue: %s" % e)
             self.redirect("/projects/%s" % issue.project.slug)
@@ -586,12 +812,31 @@ class ProjectsHandler(BaseRequest):
         
 class ProjectsJsonHandler(BaseRequest):
         def get(self):
-            output = get_cache("projects_json")
+            params = {
+                'limit': self.request.get("limit"),
+                'cursor': self.request.get("cursor"),
+                'since': self.request.get("since"),
+            }
+            output = get_cache("projects_json%s" % page_url("", params))
             if output is None:
-                projects = Project.all().order('-created_date').fetch(50)
+                # the newest projects, or those changed since a date
+                # in the order they were changed
+                limit = get_limit(params['limit'], 50, settings.JSON_MAX_LIMIT)
+                projects = Project.all()
+                try:
+                    if params['since']:
+                        projects.filter('modified_date >', parse_date(params['since'])).order('modified_date')
+                    else:
+                        projects.order('-created_date')
+                    if params['cursor']:
+                        projects.with_cursor(params['cursor'])
+                    page = projects.fetch(limit)
+                except (ValueError, db.BadValueError, db.BadRequestError):
+                    self.error(400)
+                    return
                 projects_data = {}
 
-                for project in projects:
+                for project in page:
                     data = {
                         'internal_url': "%s/projects/%s/" % (settings.SYSTEM_URL, project.slug),
                         'created_date': str(project.created_date)[0:19],
@@ -607,13 +852,23 @@ class ProjectsJsonHandler(BaseRequest):
                     'projects': projects_data,
                 }
 
+                # link to the rest of the projects if there might be more
+                if len(page) == limit:
+                    json['cursor'] = projects.cursor()
+                    json['next'] = page_url("%s/projects.json" % settings.SYSTEM_URL,
+                        dict(params, cursor=json['cursor']))
+
                 output = simplejson.dumps(json)            
-                memcache.add("projects_json", output, 3600)
+                if params['since']:
+                    memcache.add("projects_json%s" % page_url("", params), output, 60)
+                else:
+                    memcache.add("projects_json%s" % page_url("", params), output, 3600)
             self.response.headers["Content-Type"] = "application/javascript; charset=utf8"
             self.response.out.write(output)
 
 class ProjectsRssHandler(BaseRequest):
         def get(self):
+            self.response.headers["Content-Type"] = "application/rss+xml; charset=utf8"
             output = get_cache("projects_rss")
             if output is None:
                 
@@ -622,46 +877,122 @@ class ProjectsRssHandler(BaseRequest):
                     title="GitBug projects",
                     link="%s" % settings.SYSTEM_URL,
                     description="A list of the latest 20 projects on GitBug",
-                    lastBuildDate=datetime.now()
+                    lastBuildDate=datetime.now(),
+                    items=project_rss_items(projects)
                 )
 
-                for project in projects:
-                    rss.items.append(
-                        RSSItem(
-                            title=project.name,
-                            link="%s/projects/%s/" % (settings.SYSTEM_URL, project.slug),
-                            description="",
-                            pubDate=project.created_date
-                        ))
+                out = BoundedTee(self.response.out, settings.FEED_CACHE_SIZE)
+                rss.write_xml(out)
 
-                output = rss.to_xml()
+                output = out.getvalue()
+                if output is not None:
+                    memcache.add("projects_rss", output, 3600)
+            else:
+                self.response.out.write(output)
 
-                memcache.add("projects_rss", output, 3600)
-            self.response.headers["Content-Type"] = "application/rss+xml; charset=utf8"
-            self.response.out.write(output)
+class ActivityHandler(BaseRequest):
+    """
+    Base for the site wide activity feeds, which page through the
+    event log with the most recent events first
+    """
+    def get(self):
+        limit = get_limit(self.request.get("limit"), self.default_limit, self.max_limit)
+        params = {}
+        if limit != self.default_limit:
+            params['limit'] = limit
+        cursor = self.request.get("cursor")
+
+        key = "activity_%s%s" % (self.format, page_url("", dict(params, cursor=cursor)))
+        output = get_cache(key)
+        if output is None:
+            events = Event.all().order('-created_date')
+            try:
+                if cursor:
+                    events.with_cursor(cursor)
+                page = events.fetch(limit)
+            except (db.BadValueError, db.BadRequestError):
+                # not a cursor we handed out
+                self.error(400)
+                return
+
+            # link to the older events if there might be more
+            next_cursor = None
+            if len(page) == limit:
+                next_cursor = events.cursor()
+            url = "%s/activity.%s" % (settings.SYSTEM_URL, self.format)
+            output = self.render_page(page, url, params, cursor, next_cursor)
+
+            # new events only ever appear on the first page, so
+            # the pages after it can be cached for much longer
+            if cursor:
+                memcache.add(key, output, 3600)
+            else:
+                memcache.add(key, output, 60)
+
+        self.response.headers["Content-Type"] = self.content_type
+        self.response.out.write(output)
+
+class ActivityRssHandler(ActivityHandler):
+    "Recent activity on every project as RSS"
+    format = "rss"
+    content_type = "application/rss+xml; charset=utf8"
+    default_limit = settings.FEED_LIMIT
+    max_limit = settings.FEED_MAX_LIMIT
+
+    def render_page(self, page, url, params, cursor, next_cursor):
+        pages = [
+            ("self", page_url(url, dict(params, cursor=cursor))),
+            ("first", page_url(url, params)),
+        ]
+        if next_cursor:
+            pages.append(("next", page_url(url, dict(params, cursor=next_cursor))))
+        rss = PagedRSS2(
+            pages,
+            title="Activity on GitBug",
+            link="%s" % settings.SYSTEM_URL,
+            description="Issues created, changed and fixed on every project",
+            lastBuildDate=datetime.now(),
+            items=[event_rss_item(event) for event in page]
+        )
+        return rss.to_xml()
+
+class ActivityJsonHandler(ActivityHandler):
+    "Recent activity on every project in JSON"
+    format = "json"
+    content_type = "application/javascript; charset=utf8"
+    default_limit = settings.JSON_LIMIT
+    max_limit = settings.JSON_MAX_LIMIT
+
+    def render_page(self, page, url, params, cursor, next_cursor):
+        json = {
+            'date': str(datetime.now())[0:19],
+            'events': [event_json(event) for event in page],
+        }
+        if next_cursor:
+            json['cursor'] = next_cursor
+            json['next'] = page_url(url, dict(params, cursor=next_cursor))
+        return simplejson.dumps(json)
 
 class WebHookHandler(BaseRequest):
+    """
+    Accepts pushes from GitHub. The commits are processed by a task
+    so we can answer straight away, however big the push is
+    """
     def post(self, slug):
         project = Project.all().filter('slug =', slug).fetch(1)[0]
         
         key = self.request.get("key")
         
-        if key == project.key(): 
+        if key == str(project.key()): 
+            # the payload of a big push is over the task size
+            # limit, so only its key is sent with the task
+            stored = WebHookPayload.create(project, self.request.get("payload").encode('utf-8'))
             try:
-                payload = self.request.get("payload")
-                representation = simplejson.loads(payload)
-                commits = representation['commits']
-                for commit in commits:
-                    message = commit['message']
-                    search = GITBUG.search(message)
-                    if search:
-                        identifier = search.group()[7:]                                
-                        issue = Issue.all().filter('project =', project).filter('identifier =', int(identifier)).fetch(1)[0]
-                        issue.fixed = True
-                        issue.put()
-                        logging.info("issue updated via webhook: %s in %s" % (issue.name, issue.project.name))
-            except Exception, e:
-                logging.error("webhook error: %s" % e)
+                taskqueue.add(url="/admin/webhook/", params={'payload': str(stored.key())})
+                logging.info("webhook queued: %s" % project.name)
+            except taskqueue.TaskTooLargeError, e:
+                stored.delete()
+                logging.error("webhook task too large: %s" % e)
         else:
             logging.info("webhook incorrect key provided: %s" % project.name)
             
@@ -697,25 +1028,105 @@ class FaqPageHandler(BaseRequest):
         self.response.out.write(output)
 
 class UploadHandler(webapp.RequestHandler):
+    """
+    File uploads. The multipart body is read a block at a time and the
+    file saved a chunk at a time as it arrives, rather than parsing the
+    whole request into memory first
+    """
     def post(self, slug):
         project = Project.all().filter('slug =', slug).fetch(1)[0]
-        try:
-            file = self.request.POST['file']
 
-            f = DatastoreFile(data=file.value, mimetype=file.type, project=project, name=file.filename)
-            f.put()
+        # refuse files which are too big before reading any of the body
+        try:
+            length = int(self.request.headers.get('Content-Length') or 0)
+        except ValueError:
+            length = 0
+        if length > settings.FILE_MAX_SIZE:
+            self.error(413)
+            return
 
-            url = "http://%s/file/%s/%d/%s" % (self.request.host, slug, f.key().id(), f.name)
+        writer = None
+        name = mimetype = None
+        try:
+            content_type, options = cgi.parse_header(self.request.headers.get('Content-Type', ''))
+            for kind, value in read_multipart(self.request.body_file, options['boundary']):
+                if kind == 'part':
+                    if writer is not None:
+                        # the writer is forgotten once closed, as the blob
+                        # may be shared and mustn't be aborted after that
+                        blob, writer = writer.close(), None
+                        self.save(project, name, mimetype, blob)
+                    disposition, params = cgi.parse_header(value.get('content-disposition', ''))
+                    # other form fields are skipped
+                    if params.get('name') == 'file' and params.get('filename'):
+                        name = params['filename']
+                        mimetype = value.get('content-type', 'application/octet-stream')
+                        writer = BlobWriter()
+                elif writer is not None:
+                    writer.write(value)
+                    # a body without a length is checked as it's read
+                    if writer.size > settings.FILE_MAX_SIZE:
+                        writer.abort()
+                        self.error(413)
+                        return
+            if writer is not None:
+                blob, writer = writer.close(), None
+                self.save(project, name, mimetype, blob)
         except Exception, e:
+            if writer is not None:
+                writer.abort()
             logging.error("error uploading file: %s" % e)
 
         self.redirect("/projects/%s/" % slug)
 
+    def save(self, project, name, mimetype, blob):
+        "Add an uploaded file, with its data in the blob, to the project"
+        DatastoreFile.create_from_blob(project, name, mimetype, blob)
+        logging.info("file uploaded: %s in %s" % (name, project.name))
+
 class DownloadHandler(webapp.RequestHandler):
     def get(self, slug, id, filename):
         entity = DatastoreFile.get_by_id(int(id))
+        if entity is None:
+            self.error(404)
+            return
+
+        # the file at a url never changes, so browsers and
+        # caches can keep it for as long as they like
+        etag = '"%s"' % entity.content_hash
+        self.response.headers['ETag'] = etag
+        self.response.headers['Cache-Control'] = "public, max-age=31536000, immutable"
+        self.response.headers['Accept-Ranges'] = "bytes"
+        if etag_matches(self.request.headers.get('If-None-Match'), etag):
+            self.response.set_status(304)
+            return
+
+        # a range is only sent if the client has the same version, and
+        # is ignored otherwise rather than checked against this one
+        size = entity.length
+        header = self.request.headers.get('Range')
+        if_range = self.request.headers.get('If-Range')
+        if if_range and if_range.strip() != etag:
+            header = None
+        try:
+            byte_range = parse_range(header, size)
+        except ValueError:
+            self.response.set_status(416)
+            self.response.headers['Content-Range'] = "bytes */%d" % size
+            return
+
         self.response.headers['Content-Type'] = entity.mimetype
-        self.response.out.write(entity.data)
+        if byte_range is None:
+            chunks = entity.read_chunks()
+        else:
+            first, last = byte_range
+            self.response.set_status(206)
+            self.response.headers['Content-Range'] = "bytes %d-%d/%d" % (first, last, size)
+            chunks = entity.read_chunks(first, last + 1)
+
+        # written a chunk at a time rather than loading the whole file
+        for data in chunks:
+            self.response.out.write(data)
                                         
 def application():
     "Run the application"
@@ -724,6 +1135,8 @@ def application():
         ('/', Index),
         ('/projects.json$', ProjectsJsonHandler),
         ('/projects.rss$', ProjectsRssHandler),
+        ('/activity.json$', ActivityJsonHandler),
+        ('/activity.rss$', ActivityRssHandler),
         ('/projects/?$', ProjectsHandler),
         ('/projects/([A-Za-z0-9-]+)/hook/?$', WebHookHandler),
         ('/projects/([A-Za-z0-9-]+)/delete/?$', ProjectDeleteHandler),
@@ -742,8 +1155,15 @@ def application():
     application = webapp.WSGIApplication(ROUTES, debug=settings.DEBUG)
     return application
 
+# set once this instance has checked for unfinished data migrations
+MIGRATIONS_QUEUED = False
+
 def main():
     "Run the application"
+    global MIGRATIONS_QUEUED
+    if not MIGRATIONS_QUEUED:
+        queue_migrations()
+        MIGRATIONS_QUEUED = True
     run_wsgi_app(application())
 
 
@@ -1,20 +1,55 @@
+import hashlib
 from datetime import datetime
 
 from google.appengine.ext import db
 from google.appengine.ext import search
 from google.appengine.api import mail
+from google.appengine.api import memcache
+from google.appengine.api import taskqueue
 
-from lib import slugify, textile
+from lib import slugify, textile, get_in_batches, put_in_batches
 import settings
 
-class Project(db.Model):
+class TextileHtml(object):
+    """
+    Keeps the html of a description up to date. With TEXTILE_LAZY
+    set the description is only rendered by the backfill task or
+    when it's first displayed, rather than every time it's saved
+    """
+
+    def update_html(self):
+        "Render the html now, or mark it as stale if rendering lazily"
+        if settings.TEXTILE_LAZY:
+            self.html_stale = True
+            # only queue one backfill task at a time, it keeps going
+            # until there is nothing stale left
+            if memcache.add("textile_backfill", True, 60):
+                taskqueue.add(url="/admin/backfill/")
+        else:
+            self.render_html()
+
+    def render_html(self):
+        "Render the description to html"
+        self.html = textile(unicode(self.description))
+        self.html_stale = False
+
+    @property
+    def description_html(self):
+        "The html of the description, rendered now if it is stale"
+        if self.html_stale:
+            self.render_html()
+        return self.html
+
+class Project(TextileHtml, db.Model):
     "Represents a single project"
     name = db.StringProperty(required=True)
     url = db.LinkProperty()
     description = db.TextProperty()
     html = db.TextProperty()
+    html_stale = db.BooleanProperty(default=False)
     slug = db.StringProperty()
     created_date = db.DateTimeProperty(auto_now_add=True)
+    modified_date = db.DateTimeProperty()
     user = db.UserProperty(required=True)
     other_users = db.StringListProperty()
 
@@ -31,11 +66,108 @@ class Project(db.Model):
     def put(self):
         # we set the slug on the first save
         # after which it is never changed
-        self.html = textile(unicode(self.description))
+        self.update_html()
         if not self.slug:
             self.slug = slugify(unicode(self.name))
+        # so API clients can ask for what changed since they last looked
+        self.modified_date = datetime.now()
         super(Project, self).put()
 
+class Event(db.Model):
+    """
+    Something which happened to an issue, listed in the site wide
+    activity feeds. Events are only ever added, so they keep the names
+    of the issue and project rather than references which a delete
+    would leave dangling
+    """
+    action = db.StringProperty(required=True,
+        choices=set(["created", "edited", "fixed", "reopened", "referenced", "deleted"]))
+    source = db.StringProperty(default="web", choices=set(["web", "webhook"]))
+    project_name = db.StringProperty(required=True)
+    project_slug = db.StringProperty(required=True)
+    issue_name = db.StringProperty(required=True)
+    internal_url = db.StringProperty()
+    identifier = db.IntegerProperty()
+    created_date = db.DateTimeProperty(auto_now_add=True)
+
+    @classmethod
+    def create(cls, action, issue, source="web", project=None):
+        """
+        An unsaved event for something done to the issue, so it can be
+        saved in a batch. Passing the project saves looking it up again
+        """
+        if project is None:
+            project = issue.project
+        return cls(
+            action=action,
+            source=source,
+            project_name=project.name,
+            project_slug=project.slug,
+            issue_name=issue.name,
+            internal_url=issue.internal_url,
+            identifier=issue.identifier,
+        )
+
+    @classmethod
+    def record(cls, action, issue, source="web"):
+        "Add an event for something done to the issue"
+        event = cls.create(action, issue, source)
+        event.put()
+        return event
+
+class RecentCommits(db.Model):
+    "IDs of the commits most recently pushed to a project, oldest first"
+    ids = db.StringListProperty(indexed=False)
+
+    # make it easy to retrieve the object based on key
+    key_template = 'commits/%(project)s'
+
+    @classmethod
+    def key_for(cls, project):
+        "Key of the recent commits for the project"
+        return db.Key.from_path(cls.kind(), cls.key_template % {'project': project.key()})
+
+    @classmethod
+    def add(cls, project, ids):
+        """
+        Add commit ids for the project, keeping only the newest. Done
+        in a transaction so concurrent pushes don't lose each other's
+        """
+        key = cls.key_for(project)
+        def add_ids():
+            recent = cls.get(key) or cls(key=key)
+            seen = set(recent.ids)
+            combined = recent.ids + [commit_id for commit_id in ids if commit_id not in seen]
+            recent.ids = combined[-settings.WEBHOOK_RECENT_COMMITS:]
+            recent.put()
+        db.run_in_transaction(add_ids)
+
+class Migration(db.Model):
+    "Marks a data migration as finished, keyed by its name"
+    finished_date = db.DateTimeProperty(auto_now_add=True)
+
+# data migrations, run by a chain of tasks starting at the url,
+# which saves a Migration with the name once it has finished
+MIGRATIONS = [
+    ("modified_dates", "/admin/modified/"),
+    ("file_blobs", "/admin/files/"),
+]
+
+def queue_migrations():
+    """
+    Queue the tasks for any data migrations which haven't finished, so
+    they start as soon as a new version is deployed
+    """
+    for name, url in MIGRATIONS:
+        if memcache.get("migrated/%s" % name):
+            continue
+        if Migration.get_by_key_name(name) is not None:
+            memcache.set("migrated/%s" % name, True)
+        elif memcache.add("migrating/%s" % name, True, 3600):
+            # only one chain at a time, restarted after an
+            # hour in case the last one failed part way
+            taskqueue.add(url=url)
+
 class Counter(db.Model):
     "Project specific counter"
     count = db.IntegerProperty()
@@ -44,19 +176,278 @@ class Counter(db.Model):
     # make it easy to retrieve the object based on key
     key_template = 'counter/%(project)s'
 
+class FileBlob(db.Model):
+    """
+    The data of uploaded files, kept in FileChunk entities under it.
+    Files with the same content share a blob, which counts the files
+    referring to it and is deleted along with the last of them
+    """
+    sha256 = db.StringProperty(required=True)
+    size = db.IntegerProperty(required=True)
+    chunk_size = db.IntegerProperty(required=True)
+    chunk_count = db.IntegerProperty(required=True)
+    references = db.IntegerProperty(default=0)
+    created_date = db.DateTimeProperty(auto_now_add=True)
+
+    @classmethod
+    def store(cls, data):
+        """
+        A blob holding the data, with a reference added for a new file.
+        If we already have the same content it's shared rather than
+        saved again
+        """
+        blob = cls.find(hashlib.sha256(data).hexdigest())
+        if blob is not None:
+            return blob
+        writer = BlobWriter()
+        writer.write(data)
+        return writer.close()
+
+    @classmethod
+    def find(cls, sha256):
+        "An existing blob with the content, with a reference added, or None"
+        existing = cls.all().filter('sha256 =', sha256).get()
+        if existing is None:
+            return None
+        # None if the last file using it was deleted meanwhile
+        return cls.add_reference(existing.key())
+
+    @classmethod
+    def add_reference(cls, key):
+        "Count another file using the blob, returning None if it's gone"
+        def add():
+            blob = cls.get(key)
+            if blob is not None:
+                blob.references += 1
+                blob.put()
+            return blob
+        return db.run_in_transaction(add)
+
+    @classmethod
+    def release(cls, key):
+        "Count one less file using the blob, deleting it if none are left"
+        def remove():
+            blob = cls.get(key)
+            if blob is None:
+                return
+            blob.references -= 1
+            if blob.references > 0:
+                blob.put()
+            else:
+                # the chunks are in the same entity group so
+                # they go in the same transaction
+                db.delete([key] + blob.chunk_keys())
+        db.run_in_transaction(remove)
+
+    def chunk_keys(self):
+        "Keys of the chunks of the blob, in order"
+        return [FileChunk.key_for(self.key(), index) for index in range(self.chunk_count)]
+
+class BlobWriter(object):
+    """
+    Writes data to a new FileBlob as it arrives, hashing it and saving
+    a chunk at a time so the whole file is never held in memory
+    """
+    def __init__(self):
+        start, end = db.allocate_ids(db.Key.from_path(FileBlob.kind(), 1), 1)
+        self.key = db.Key.from_path(FileBlob.kind(), start)
+        self.chunk_size = settings.FILE_CHUNK_SIZE
+        self.hash = hashlib.sha256()
+        self.size = 0
+        self.count = 0
+        self.buffer = []
+        self.buffered = 0
+
+    def write(self, data):
+        "Add some data, saving any chunks which are now full"
+        self.hash.update(data)
+        self.size += len(data)
+        offset = 0
+        while offset < len(data):
+            part = data[offset:offset + self.chunk_size - self.buffered]
+            self.buffer.append(part)
+            self.buffered += len(part)
+            offset += len(part)
+            if self.buffered == self.chunk_size:
+                self.write_chunk()
+
+    def write_chunk(self):
+        "Save the buffered data as the next chunk"
+        # saved one at a time as each is close to the RPC size limit
+        FileChunk(key=FileChunk.key_for(self.key, self.count), data="".join(self.buffer)).put()
+        self.count += 1
+        self.buffer = []
+        self.buffered = 0
+
+    def close(self):
+        """
+        Finish the blob and return it, or if we already have the same
+        content throw away what was written and return that instead
+        """
+        if self.buffered:
+            self.write_chunk()
+        sha256 = self.hash.hexdigest()
+        blob = FileBlob.find(sha256)
+        if blob is not None:
+            self.abort()
+            return blob
+        # the chunks are written first so the blob is only
+        # found by other uploads once it's complete
+        blob = FileBlob(key=self.key, sha256=sha256, size=self.size, references=1,
+            chunk_size=self.chunk_size, chunk_count=self.count)
+        blob.put()
+        return blob
+
+    def abort(self):
+        "Delete the chunks written so far"
+        db.delete([FileChunk.key_for(self.key, index) for index in range(self.count)])
+
 class DatastoreFile(db.Model):
-    data = db.BlobProperty(required=True)
+    """
+    An uploaded file, with its data in a FileBlob shared by files with
+    the same content. Files uploaded before blobs have their data in
+    FileChunk entities under them, or before chunks in data
+    """
+    data = db.BlobProperty()
     mimetype = db.StringProperty(required=True)
     project = db.ReferenceProperty(Project)
     name = db.StringProperty(required=True)
     icon_url = db.StringProperty()
-    
-class Issue(search.SearchableModel):
+    blob = db.ReferenceProperty(FileBlob)
+    # copied from the blob so downloads don't need to fetch it
+    size = db.IntegerProperty()
+    sha256 = db.StringProperty()
+    chunk_size = db.IntegerProperty()
+    chunk_count = db.IntegerProperty(default=0)
+
+    @classmethod
+    def create(cls, project, name, mimetype, data):
+        "Save an uploaded file, sharing the data with any file the same"
+        return cls.create_from_blob(project, name, mimetype, FileBlob.store(data))
+
+    @classmethod
+    def create_from_blob(cls, project, name, mimetype, blob):
+        """
+        Save an uploaded file with its data already in a blob, which
+        has had a reference added for the file
+        """
+        datastore_file = cls(project=project, name=name, mimetype=mimetype, blob=blob,
+            size=blob.size, sha256=blob.sha256, chunk_size=blob.chunk_size,
+            chunk_count=blob.chunk_count)
+        # the blob is in another entity group, so rather than a
+        # transaction the reference is given back if the put fails
+        try:
+            datastore_file.put()
+        except:
+            FileBlob.release(blob.key())
+            raise
+        return datastore_file
+
+    def blob_key(self):
+        "Key of the blob holding the data, without fetching it"
+        return DatastoreFile.blob.get_value_for_datastore(self)
+
+    def chunk_keys(self):
+        "Keys of the chunks of the file, in order"
+        parent = self.blob_key() or self.key()
+        return [FileChunk.key_for(parent, index) for index in range(self.chunk_count)]
+
+    @property
+    def length(self):
+        "Size of the file in bytes"
+        if self.data is not None:
+            return len(self.data)
+        return self.size
+
+    @property
+    def content_hash(self):
+        "SHA-256 of the data, used as the ETag"
+        if self.data is not None:
+            return hashlib.sha256(self.data).hexdigest()
+        return self.sha256
+
+    def read_chunks(self, start=0, stop=None):
+        """
+        The data of the file from start up to stop a chunk at a time,
+        fetching a few chunks with each get so only those are held in
+        memory. Only the chunks with data in the range are fetched
+        """
+        if self.data is not None:
+            yield self.data[start:stop]
+            return
+        if stop is None:
+            stop = self.size
+        if start >= stop:
+            return
+        first = start // self.chunk_size
+        keys = self.chunk_keys()[first:(stop - 1) // self.chunk_size + 1]
+        offset = first * self.chunk_size
+        for index in range(0, len(keys), settings.FILE_CHUNK_BATCH):
+            for chunk in db.get(keys[index:index + settings.FILE_CHUNK_BATCH]):
+                yield chunk.data[max(start - offset, 0):stop - offset]
+                offset += self.chunk_size
+
+    def delete(self):
+        "Delete the file, and its data if no other file shares it"
+        if self.blob_key():
+            super(DatastoreFile, self).delete()
+            FileBlob.release(self.blob_key())
+        else:
+            db.delete([self.key()] + self.chunk_keys())
+
+class WebHookPayload(db.Model):
+    """
+    A webhook payload waiting for the task which processes it, as big
+    pushes are over the task size limit. The payload is kept in
+    FileChunk entities under it, as it can be over the entity limit too
+    """
+    project = db.ReferenceProperty(Project, required=True)
+    chunk_count = db.IntegerProperty(required=True)
+    created_date = db.DateTimeProperty(auto_now_add=True)
+
+    @classmethod
+    def create(cls, project, payload):
+        "Save a payload, the chunks first so it's only found once complete"
+        start, end = db.allocate_ids(db.Key.from_path(cls.kind(), 1), 1)
+        key = db.Key.from_path(cls.kind(), start)
+        count = 0
+        for offset in range(0, len(payload), settings.FILE_CHUNK_SIZE):
+            FileChunk(key=FileChunk.key_for(key, count),
+                data=payload[offset:offset + settings.FILE_CHUNK_SIZE]).put()
+            count += 1
+        stored = cls(key=key, project=project, chunk_count=count)
+        stored.put()
+        return stored
+
+    def chunk_keys(self):
+        "Keys of the chunks of the payload, in order"
+        return [FileChunk.key_for(self.key(), index) for index in range(self.chunk_count)]
+
+    def read(self):
+        "The whole payload"
+        return "".join([chunk.data for chunk in db.get(self.chunk_keys())])
+
+    def delete(self):
+        "Delete the payload along with its chunks"
+        db.delete([self.key()] + self.chunk_keys())
+
+class FileChunk(db.Model):
+    "Part of the data of a FileBlob or a WebHookPayload, stored under it"
+    data = db.BlobProperty(required=True)
+
+    @classmethod
+    def key_for(cls, parent, index):
+        "Key of a chunk of the data, which sort in order"
+        return db.Key.from_path(cls.kind(), "chunk%06d" % index, parent=parent)
+
+class Issue(TextileHtml, search.SearchableModel):
     "Issue or bug representation"
     name = db.StringProperty(required=True)
     description = db.TextProperty()
     html = db.TextProperty()
+    html_stale = db.BooleanProperty(default=False)
     created_date = db.DateTimeProperty(auto_now_add=True)
+    modified_date = db.DateTimeProperty()
     email = db.EmailProperty()
     project = db.ReferenceProperty(Project, required=True)
     internal_url = db.StringProperty()
@@ -66,11 +457,81 @@ class Issue(search.SearchableModel):
     identifier = db.IntegerProperty()
     priority = db.StringProperty(default="Normal", choices=set(["High", "Normal", "Low"]))
     
+    @classmethod
+    def get_by_identifiers(cls, project, identifiers):
+        """
+        The issues in the project with the given identifiers, in a
+        dictionary keyed by identifier. They are found with two batch
+        gets through IssueIdentifier rather than a query each, split
+        into calls of at most DATASTORE_BATCH_SIZE
+        """
+        identifiers = sorted(set(identifiers))
+        lookups = get_in_batches([IssueIdentifier.key_for(project, identifier)
+            for identifier in identifiers])
+        keys = [IssueIdentifier.issue.get_value_for_datastore(lookup)
+            for lookup in lookups if lookup is not None]
+
+        found = {}
+        for issue in get_in_batches(keys):
+            # the lookup outlives an issue deleted with db.delete
+            if issue is not None:
+                found[issue.identifier] = issue
+
+        # issues saved before the lookups existed are found with a
+        # query, and given a lookup so it's quicker next time
+        created = []
+        for identifier, lookup in zip(identifiers, lookups):
+            if lookup is None:
+                issue = cls.all().filter('project =', project).filter('identifier =', identifier).get()
+                if issue is not None:
+                    found[identifier] = issue
+                    created.append(IssueIdentifier.create(project, issue))
+        put_in_batches(created)
+        return found
+
+    def prepare_put(self):
+        """
+        Set the dates, returning the fixed email to send once the issue
+        is saved, or None. Called by put, and by anything saving issues
+        in a batch with db.put
+        """
+        # feeds list the most recently changed issues first, and
+        # API clients can ask for what changed since they last looked
+        self.modified_date = datetime.now()
+
+        # if the bug gets fixed then we store that date
+        # if it's later marked as open we clear the date
+        if self.fixed:
+            self.fixed_date = datetime.now()
+            self.priority = None
+        else:
+            self.fixed_date = None
+        
+        # if the bug has been fixed then send an email, but only
+        # after the put so a failed save doesn't send it twice
+        if self.fixed and self.email:
+            return mail.EmailMessage(sender="prokontrol@gmail.com",
+                to=self.email,
+                subject="[GitBug] Your bug has been fixed",
+                body="""You requested to be emailed when a bug on GitBug was fixed:
+              
+Issue name: %s
+Description: %s
+
+-------
+
+%s
+
+-------
+
+Thanks for using GitBug <http://gitbug.appspot.com>. A very simple issue tracker.
+""" % (self.name, self.description, self.fixed_description))
+
     def put(self):
         "Overridden save method"
         # we save the html here as it's faster than processing 
         # everytime we display it
-        self.html = textile(unicode(self.description))
+        self.update_html()
         
         # internal url is set on first save and then not changed
         # as the admin interface doesn't allow for changing name
@@ -81,7 +542,8 @@ class Issue(search.SearchableModel):
         # each issue has a per project unique identifier which is based
         # on an integer. This integer is stored in counter in the datastore
         # which is associated with the project
-        if not self.identifier:
+        new_identifier = not self.identifier
+        if new_identifier:
             counter = Counter.get_by_key_name("counter/%s" % self.project.name)
             if counter is None:
                 # if it's the first issue we need to create the counter
@@ -97,31 +559,38 @@ class Issue(search.SearchableModel):
             # save the count against the issue for use in the identifier
             self.identifier = counter.count
 
-        # if the bug gets fixed then we store that date
-        # if it's later marked as open we clear the date
-        if self.fixed:
-            self.fixed_date = datetime.now()
-            self.priority = None
-        else:
-            self.fixed_date = None
-        
-        # if the bug has been fixed then send an email
-        if self.fixed and self.email:
-            mail.send_mail(sender="prokontrol@gmail.com",
-                to=self.email,
-                subject="[GitBug] Your bug has been fixed",
-                body="""You requested to be emailed when a bug on GitBug was fixed:
-              
-Issue name: %s
-Description: %s
+        message = self.prepare_put()
+        super(Issue, self).put()
+        if message is not None:
+            message.send()
 
--------
+        # so webhooks can find the issue by identifier
+        if new_identifier:
+            IssueIdentifier.create(self.project, self).put()
 
-%s
+    def delete(self):
+        "Delete the issue along with its identifier lookup"
+        keys = [self.key()]
+        if self.identifier:
+            keys.append(IssueIdentifier.key_for(self.project, self.identifier))
+        db.delete(keys)
 
--------
+class IssueIdentifier(db.Model):
+    "Finds an issue from its project and identifier with a get"
+    issue = db.ReferenceProperty(Issue, required=True)
 
-Thanks for using GitBug <http://gitbug.appspot.com>. A very simple issue tracker.
-""" % (self.name, self.description, self.fixed_description))
-        
-        super(Issue, self).put()
+    # make it easy to retrieve the object based on key
+    key_template = 'identifier/%(project)s/%(identifier)d'
+
+    @classmethod
+    def key_for(cls, project, identifier):
+        "Key of the lookup for an identifier in the project"
+        return db.Key.from_path(cls.kind(), cls.key_template % {
+            'project': project.key(),
+            'identifier': identifier,
+        })
+
+    @classmethod
+    def create(cls, project, issue):
+        "An unsaved lookup for the issue"
+        return cls(key=cls.key_for(project, issue.identifier), issue=issue)
@@ -13,3 +13,52 @@ CACHE = not debug
 
 # URL of the current system, used in feeds
 SYSTEM_URL = "http://123mvo.appspot.com"
+
+# limits for rendering textile descriptions, anything larger or slower
+# than this is shown as plain text instead. The time is checked between
+# the regular expressions, but some of them are quadratic on crafted
+# input, so the size is what bounds the slowest one. At 8000 characters
+# that takes about 1.2s
+TEXTILE_MAX_SIZE = 8000
+TEXTILE_TIMEOUT = 2.0
+
+# when set descriptions aren't rendered as they are saved, a background
+# task renders them in batches instead. Useful for bulk imports through
+# the remote api console
+TEXTILE_LAZY = False
+TEXTILE_BACKFILL_BATCH = 50
+
+# feeds are streamed to the response and cached if they are no bigger
+# than this, memcache doesn't store values over 1MB
+FEED_CACHE_SIZE = 1000000
+
+# number of issues in a page of a project feed, ?limit= can ask
+# for more up to the maximum
+FEED_LIMIT = 50
+FEED_MAX_LIMIT = 500
+
+# number of issues in a page of the project JSON when it's paged with
+# ?limit=, ?cursor= or ?since=
+JSON_LIMIT = 100
+JSON_MAX_LIMIT = 500
+
+# the datastore takes at most 500 entities in a call, and batch puts
+# are also split to keep each call under this many bytes
+DATASTORE_BATCH_SIZE = 500
+DATASTORE_BATCH_BYTES = 1000000
+
+# number of commit ids remembered for each project, so commits in a
+# redelivered webhook payload are skipped
+WEBHOOK_RECENT_COMMITS = 1000
+
+# uploaded files are stored in chunks of this many bytes, under the
+# 1MB entity limit, and downloads fetch this many chunks at a time
+FILE_CHUNK_SIZE = 500000
+FILE_CHUNK_BATCH = 2
+
+# largest file which can be uploaded, requests are limited to 32MB
+FILE_MAX_SIZE = 30000000
+
+# record how long each phase of rendering textile takes, the totals
+# are shown on the admin page
+TEXTILE_PROFILE = False
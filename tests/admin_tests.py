@@ -7,7 +7,11 @@ from webtest import TestApp, AppError
 
 from google.appengine.api import urlfetch, mail_stub, apiproxy_stub_map, urlfetch_stub, user_service_stub, datastore_file_stub
 from google.appengine.api.memcache import memcache_stub
+from google.appengine.api.taskqueue import taskqueue_stub
 from google.appengine.api.urlfetch import DownloadError, InvalidURLError
+from google.appengine.api import users
+from google.appengine.ext import db
+from django.utils import simplejson
 
 # insert application path
 app_path = os.path.join(
@@ -15,7 +19,9 @@ app_path = os.path.join(
 )
 sys.path.insert(0, app_path)
 
-from admin import application
+from admin import application, commit_references, BackfillHtml
+from models import Project, Issue, IssueIdentifier, Event, RecentCommits, DatastoreFile, FileBlob, Migration
+from models import WebHookPayload, FileChunk
 import settings 
 
 class AdminTest(unittest.TestCase):
@@ -27,6 +33,8 @@ class AdminTest(unittest.TestCase):
         apiproxy_stub_map.apiproxy.RegisterStub('user', user_service_stub.UserServiceStub())
         apiproxy_stub_map.apiproxy.RegisterStub('urlfetch', urlfetch_stub.URLFetchServiceStub())
         apiproxy_stub_map.apiproxy.RegisterStub('memcache', memcache_stub.MemcacheServiceStub())        
+        self.taskqueue = taskqueue_stub.TaskQueueServiceStub()
+        apiproxy_stub_map.apiproxy.RegisterStub('taskqueue', self.taskqueue)
         stub = datastore_file_stub.DatastoreFileStub('temp', '/dev/null', '/dev/null')
         apiproxy_stub_map.apiproxy.RegisterStub('datastore_v3', stub)
         
@@ -62,6 +70,201 @@ class AdminTest(unittest.TestCase):
         response = self.app.post('/admin/clearcache', expect_errors=True)        
         self.assertEquals("302 Moved Temporarily", response.status)
 
+    def test_backfill_renders_stale_html(self):
+        project = Project(name="test", user=users.User("test@example.com"),
+            description="*project*", html_stale=True)
+        db.put(project)
+        response = self.app.post('/admin/backfill/', expect_errors=True)
+        self.assertEquals("200 OK", response.status)
+        project = Project.get(project.key())
+        self.assertFalse(project.html_stale)
+        self.assertEquals("<p><strong>project</strong></p>", project.html)
+
+    def test_backfill_keeps_later_edits(self):
+        project = Project(name="test", user=users.User("test@example.com"),
+            description="*project*", html_stale=True)
+        db.put(project)
+        # edited after the backfill fetched it
+        self.assertFalse(BackfillHtml().save_html(project.key(), "*old*", "<p>old</p>"))
+        self.assertTrue(Project.get(project.key()).html_stale)
+
+    def test_backfill_requeued_for_missed_descriptions(self):
+        project = Project(name="test", user=users.User("test@example.com"),
+            description="*project*", html_stale=True)
+        db.put(project)
+        # saved stale again while the last batch was rendered
+        save_html = BackfillHtml.save_html
+        BackfillHtml.save_html = lambda self, key, description, html: False
+        try:
+            self.app.post('/admin/backfill/')
+        finally:
+            BackfillHtml.save_html = save_html
+        tasks = self.taskqueue.GetTasks('default')
+        self.assertEquals(["/admin/backfill/"], [task['url'] for task in tasks])
+
+    def test_modified_dates_migration_finishes(self):
+        self.app.post('/admin/modified/', {'kind': 'Project'})
+        self.assertNotEqual(None, Migration.get_by_key_name("modified_dates"))
+
+    def test_stale_html_rendered_when_read(self):
+        project = Project(name="test", user=users.User("test@example.com"),
+            description="*project*", html_stale=True)
+        self.assertEquals("<p><strong>project</strong></p>", project.description_html)
+
+    def post_webhook(self, project, commits):
+        stored = WebHookPayload.create(project, simplejson.dumps({'commits': commits}))
+        return self.app.post('/admin/webhook/', {'payload': str(stored.key())})
+
+    def test_webhook_fixes_issues(self):
+        project = Project(name="hook", user=users.User("test@example.com"))
+        project.put()
+        for name in ["first", "second"]:
+            Issue(name=name, project=project).put()
+        response = self.post_webhook(project, [
+            {'message': 'Fixes #gitbug2'},
+            {'message': 'No reference'},
+            {'message': 'Missing #gitbug99'},
+        ])
+        self.assertEquals("200 OK", response.status)
+        fixed = dict([(issue.name, issue.fixed) for issue in Issue.all()])
+        self.assertEquals({'first': False, 'second': True}, fixed)
+        self.assertEquals(["fixed"], [event.action for event in Event.all()])
+
+    def test_webhook_saved_in_batches(self):
+        project = Project(name="hook", user=users.User("test@example.com"))
+        project.put()
+        for name in ["first", "second", "third"]:
+            Issue(name=name, project=project).put()
+        batch_size = settings.DATASTORE_BATCH_SIZE
+        settings.DATASTORE_BATCH_SIZE = 2
+        try:
+            self.post_webhook(project, [{'message': 'Fixes #gitbug1, #gitbug2, #gitbug3'}])
+        finally:
+            settings.DATASTORE_BATCH_SIZE = batch_size
+        self.assertEquals(3, Issue.all().filter('fixed =', True).count())
+        self.assertEquals(3, Event.all().count())
+
+    def test_webhook_issues_saved_before_lookups(self):
+        project = Project(name="hook", user=users.User("test@example.com"))
+        project.put()
+        issue = Issue(name="old", project=project)
+        issue.put()
+        db.delete(IssueIdentifier.key_for(project, issue.identifier))
+        self.post_webhook(project, [{'message': 'Fixes #gitbug1'}])
+        self.assertTrue(Issue.get(issue.key()).fixed)
+        self.assertNotEqual(None, IssueIdentifier.get(IssueIdentifier.key_for(project, 1)))
+
+    def test_webhook_skips_fixed_issues(self):
+        project = Project(name="hook", user=users.User("test@example.com"))
+        project.put()
+        Issue(name="done", project=project, fixed=True).put()
+        self.post_webhook(project, [{'message': 'Fixes #gitbug1'}, {'message': 'Again #gitbug1'}])
+        self.assertEquals(0, Event.all().count())
+
+    def test_fixed_email_left_until_saved(self):
+        project = Project(name="hook", user=users.User("test@example.com"))
+        project.put()
+        issue = Issue(name="mailed", project=project, email="reporter@example.com")
+        issue.put()
+        self.assertEquals(None, issue.prepare_put())
+        issue.fixed = True
+        issue.fixed_description = "Fixes #gitbug1"
+        message = issue.prepare_put()
+        self.assertEquals("reporter@example.com", message.to)
+        # only returned to be sent, the issue isn't saved here
+        self.assertFalse(Issue.get(issue.key()).fixed)
+
+    def test_commit_references(self):
+        self.assertEquals([('fixed', 52)], commit_references("changed settings file which fixes bug #gitbug52"))
+        self.assertEquals([('fixed', 1), ('fixed', 2), ('referenced', 3), ('reopened', 4)],
+            commit_references("Fixes #gitbug1, #gitbug2, refs #gitbug3 and reopens #gitbug4"))
+        self.assertEquals([], commit_references("No reference"))
+
+    def test_webhook_verbs(self):
+        project = Project(name="hook", user=users.User("test@example.com"))
+        project.put()
+        for name in ["first", "second", "third"]:
+            Issue(name=name, project=project).put()
+        third = Issue.all().filter('name =', 'third').get()
+        third.fixed = True
+        third.put()
+        self.post_webhook(project, [
+            {'message': 'Fixes #gitbug1 and #gitbug2'},
+            {'message': 'Refs #gitbug1, reopens #gitbug3'},
+            {'message': 'Reopens #gitbug2'},
+        ])
+        issues = dict([(issue.name, issue) for issue in Issue.all()])
+        self.assertTrue(issues['first'].fixed)
+        self.assertEquals('Fixes #gitbug1 and #gitbug2', issues['first'].fixed_description)
+        self.assertFalse(issues['second'].fixed)
+        self.assertFalse(issues['third'].fixed)
+        actions = sorted([event.action for event in Event.all()])
+        self.assertEquals(["fixed", "fixed", "referenced", "reopened", "reopened"], actions)
+
+    def test_webhook_redelivery_skipped(self):
+        project = Project(name="hook", user=users.User("test@example.com"))
+        project.put()
+        Issue(name="first", project=project).put()
+        commits = [{'id': 'a1', 'message': 'Refs #gitbug1'}]
+        self.post_webhook(project, commits)
+        self.post_webhook(project, commits)
+        self.post_webhook(project, commits + [{'id': 'b2', 'message': 'Refs #gitbug1'}])
+        self.assertEquals(2, Event.all().count())
+
+    def test_recent_commits_bounded(self):
+        project = Project(name="hook", user=users.User("test@example.com"))
+        project.put()
+        limit = settings.WEBHOOK_RECENT_COMMITS
+        settings.WEBHOOK_RECENT_COMMITS = 3
+        try:
+            RecentCommits.add(project, ['a', 'b'])
+            RecentCommits.add(project, ['b', 'c', 'd'])
+        finally:
+            settings.WEBHOOK_RECENT_COMMITS = limit
+        recent = RecentCommits.get(RecentCommits.key_for(project))
+        self.assertEquals(['b', 'c', 'd'], recent.ids)
+
+    def test_file_data_moved_to_blobs(self):
+        project = Project(name="files", user=users.User("test@example.com"))
+        project.put()
+        old = DatastoreFile(data="old data", mimetype="text/plain", project=project, name="old.txt")
+        old.put()
+        DatastoreFile.create(project, "copy.txt", "text/plain", "old data")
+        response = self.app.post('/admin/files/', expect_errors=True)
+        self.assertEquals("200 OK", response.status)
+        old = DatastoreFile.get(old.key())
+        self.assertEquals(None, old.data)
+        self.assertEquals(8, old.size)
+        self.assertEquals("old data", "".join(old.read_chunks()))
+        self.assertEquals(2, FileBlob.all().get().references)
+        self.assertNotEqual(None, Migration.get_by_key_name("file_blobs"))
+        # run again, as a retried task would be
+        self.app.post('/admin/files/')
+        self.assertEquals(2, FileBlob.all().get().references)
+
+    def test_webhook_bad_payload(self):
+        project = Project(name="hook", user=users.User("test@example.com"))
+        project.put()
+        stored = WebHookPayload.create(project, 'nonsense')
+        response = self.app.post('/admin/webhook/', {'payload': str(stored.key())})
+        self.assertEquals("200 OK", response.status)
+        self.assertEquals(0, WebHookPayload.all().count())
+
+    def test_webhook_payload_deleted(self):
+        project = Project(name="hook", user=users.User("test@example.com"))
+        project.put()
+        self.post_webhook(project, [{'message': 'no references'}])
+        self.assertEquals(0, WebHookPayload.all().count())
+        self.assertEquals(0, FileChunk.all().count())
+
+    def test_webhook_payload_chunked(self):
+        project = Project(name="hook", user=users.User("test@example.com"))
+        project.put()
+        payload = simplejson.dumps({'commits': [{'message': 'x' * settings.FILE_CHUNK_SIZE}]})
+        stored = WebHookPayload.create(project, payload)
+        self.assertEquals(2, stored.chunk_count)
+        self.assertEquals(payload, WebHookPayload.get(stored.key()).read())
+
 
                                        
 if __name__ == "__main__":
@@ -3,11 +3,18 @@
 import sys
 import os
 import unittest
+import cgi
+import base64
+from datetime import datetime, timedelta
 from webtest import TestApp, AppError
+from django.utils import simplejson
 
 from google.appengine.api import urlfetch, mail_stub, apiproxy_stub_map, urlfetch_stub, user_service_stub, datastore_file_stub
 from google.appengine.api.memcache import memcache_stub
+from google.appengine.api.taskqueue import taskqueue_stub
 from google.appengine.api.urlfetch import DownloadError, InvalidURLError
+from google.appengine.api import users
+from google.appengine.ext import db
 
 # insert application path
 app_path = os.path.join(
@@ -16,6 +23,7 @@ app_path = os.path.join(
 sys.path.insert(0, app_path)
 
 from main import application
+from models import Project, Issue, Event, DatastoreFile, FileBlob, FileChunk, WebHookPayload
 import settings 
 
 class FunctionalTest(unittest.TestCase):
@@ -27,6 +35,8 @@ class FunctionalTest(unittest.TestCase):
         apiproxy_stub_map.apiproxy.RegisterStub('user', user_service_stub.UserServiceStub())
         apiproxy_stub_map.apiproxy.RegisterStub('urlfetch', urlfetch_stub.URLFetchServiceStub())
         apiproxy_stub_map.apiproxy.RegisterStub('memcache', memcache_stub.MemcacheServiceStub())        
+        self.taskqueue = taskqueue_stub.TaskQueueServiceStub()
+        apiproxy_stub_map.apiproxy.RegisterStub('taskqueue', self.taskqueue)
         stub = datastore_file_stub.DatastoreFileStub('temp', '/dev/null', '/dev/null')
         apiproxy_stub_map.apiproxy.RegisterStub('datastore_v3', stub)
         
@@ -47,6 +57,253 @@ class FunctionalTest(unittest.TestCase):
     def test_web_view_return_correct_mime_type(self):
         response = self.app.get('/', expect_errors=True)
         self.assertEquals(response.content_type, "text/html")
+
+    def create_issues(self, count):
+        project = Project(name="feed", user=users.User("test@example.com"))
+        project.put()
+        for i in range(count):
+            Issue(name="issue %d" % i, project=project).put()
+        return project
+
+    def test_project_feed_is_paged(self):
+        self.create_issues(3)
+        response = self.app.get('/projects/feed.rss?limit=2', expect_errors=True)
+        self.assertEquals("200 OK", response.status)
+        self.assertEquals(2, response.body.count("<item>"))
+        response.mustcontain('rel="next"')
+        # the most recently changed issue comes first
+        self.assertTrue(response.body.index("issue 2") < response.body.index("issue 1"))
+
+    def test_project_feed_last_page(self):
+        self.create_issues(1)
+        response = self.app.get('/projects/feed.rss', expect_errors=True)
+        self.assertEquals(1, response.body.count("<item>"))
+        self.assertFalse('rel="next"' in response.body)
+
+    def test_project_feed_bad_cursor(self):
+        self.create_issues(1)
+        response = self.app.get('/projects/feed.rss?cursor=nonsense', expect_errors=True)
+        self.assertEquals("400 Bad Request", response.status)
+        self.assertFalse("rss" in response.content_type)
+
+    def test_project_feed_missing_project(self):
+        response = self.app.get('/projects/missing.rss', expect_errors=True)
+        self.assertEquals("404 Not Found", response.status)
+        self.assertEquals("text/html", response.content_type)
+
+    def test_project_json_unpaged(self):
+        self.create_issues(3)
+        json = simplejson.loads(self.app.get('/projects/feed.json').body)
+        self.assertEquals(3, len(json['issues']))
+        self.assertFalse('next' in json)
+
+    def test_project_json_paged(self):
+        self.create_issues(3)
+        json = simplejson.loads(self.app.get('/projects/feed.json?limit=2').body)
+        self.assertEquals(["issue 0", "issue 1"], sorted(json['issues'].keys()))
+        json = simplejson.loads(self.app.get('/projects/feed.json?limit=2&cursor=%s' % json['cursor']).body)
+        self.assertEquals(["issue 2"], json['issues'].keys())
+
+    def test_project_json_since(self):
+        self.create_issues(2)
+        since = (datetime.now() + timedelta(hours=1)).strftime("%Y-%m-%d %H:%M:%S")
+        json = simplejson.loads(self.app.get('/projects/feed.json?since=%s' % since).body)
+        self.assertEquals({}, json['issues'])
+        json = simplejson.loads(self.app.get('/projects/feed.json?since=2000-01-01 00:00:00').body)
+        self.assertEquals(2, len(json['issues']))
+
+    def test_project_json_bad_since(self):
+        self.create_issues(1)
+        response = self.app.get('/projects/feed.json?since=yesterday', expect_errors=True)
+        self.assertEquals("400 Bad Request", response.status)
+        self.assertFalse("javascript" in response.content_type)
+
+    def test_projects_json_since(self):
+        self.create_issues(1)
+        json = simplejson.loads(self.app.get('/projects.json?since=2000-01-01 00:00:00').body)
+        self.assertEquals(["feed"], json['projects'].keys())
+
+    def test_activity_recorded(self):
+        self.create_issues(0)
+        self.app.post('/projects/feed/', {'name': 'logged', 'description': '', 'priority': 'Normal'})
+        self.app.post('/projects/feed/logged/', {'name': 'logged', 'description': '', 'priority': 'Normal', 'fixed': '1'})
+        self.app.post('/projects/feed/logged/delete/')
+        actions = [event.action for event in Event.all().order('created_date')]
+        self.assertEquals(["created", "fixed", "deleted"], actions)
+
+    def test_activity_json_is_paged(self):
+        project = self.create_issues(3)
+        for issue in project.issue_set:
+            Event.record("created", issue)
+        json = simplejson.loads(self.app.get('/activity.json?limit=2').body)
+        self.assertEquals(2, len(json['events']))
+        json = simplejson.loads(self.app.get('/activity.json?limit=2&cursor=%s' % json['cursor']).body)
+        self.assertEquals(1, len(json['events']))
+        self.assertFalse('next' in json)
+
+    def test_activity_rss(self):
+        project = self.create_issues(1)
+        Event.record("fixed", project.issue_set.get(), source="webhook")
+        response = self.app.get('/activity.rss')
+        self.assertEquals(1, response.body.count("<item>"))
+        response.mustcontain("issue 0 fixed in feed by a commit")
+
+    def test_webhook_queues_payload(self):
+        project = self.create_issues(1)
+        payload = simplejson.dumps({'commits': [{'message': 'Fixes #gitbug1'}]})
+        response = self.app.post('/projects/feed/hook/', {'key': str(project.key()), 'payload': payload})
+        self.assertEquals("200 OK", response.status)
+        tasks = self.taskqueue.GetTasks('default')
+        self.assertEquals(1, len(tasks))
+        self.assertEquals("/admin/webhook/", tasks[0]['url'])
+        # only the key of the stored payload is sent with the task
+        stored = WebHookPayload.all().get()
+        self.assertEquals(payload, stored.read())
+        self.assertEquals(str(stored.key()), cgi.parse_qs(base64.b64decode(tasks[0]['body']))['payload'][0])
+        # nothing is changed until the task runs
+        self.assertFalse(Issue.all().get().fixed)
+
+    def test_webhook_wrong_key(self):
+        self.create_issues(1)
+        self.app.post('/projects/feed/hook/', {'key': 'wrong', 'payload': '{}'})
+        self.assertEquals([], self.taskqueue.GetTasks('default'))
+
+    def upload(self, name, data):
+        self.create_issues(0)
+        self.app.post('/projects/feed/upload/', upload_files=[('file', name, data)])
+        return DatastoreFile.all().filter('name =', name).get()
+
+    def test_upload_split_into_chunks(self):
+        chunk_size = settings.FILE_CHUNK_SIZE
+        settings.FILE_CHUNK_SIZE = 10
+        try:
+            data = "".join([chr(i % 256) for i in range(55)])
+            datastore_file = self.upload("log.txt", data)
+        finally:
+            settings.FILE_CHUNK_SIZE = chunk_size
+        self.assertEquals(6, datastore_file.chunk_count)
+        self.assertEquals(55, datastore_file.size)
+        response = self.app.get('/projects/feed/file/%d/log.txt' % datastore_file.key().id())
+        self.assertEquals(data, response.body)
+
+    def test_download_range(self):
+        chunk_size = settings.FILE_CHUNK_SIZE
+        settings.FILE_CHUNK_SIZE = 10
+        try:
+            data = "".join([chr(ord('a') + i % 26) for i in range(55)])
+            datastore_file = self.upload("log.txt", data)
+        finally:
+            settings.FILE_CHUNK_SIZE = chunk_size
+        url = '/projects/feed/file/%d/log.txt' % datastore_file.key().id()
+        response = self.app.get(url, headers={'Range': 'bytes=12-32'})
+        self.assertEquals("206 Partial Content", response.status)
+        self.assertEquals(data[12:33], response.body)
+        self.assertEquals("bytes 12-32/55", response.headers['Content-Range'])
+        response = self.app.get(url, headers={'Range': 'bytes=60-'}, expect_errors=True)
+        self.assertEquals("416 Requested Range Not Satisfiable", response.status)
+        # ranges which can't be parsed are ignored rather than refused
+        for header in ['bytes=abc', 'bytes=32-12', 'bytes=0-1,4-5']:
+            response = self.app.get(url, headers={'Range': header})
+            self.assertEquals("200 OK", response.status)
+            self.assertEquals(data, response.body)
+
+    def test_download_etag(self):
+        datastore_file = self.upload("log.txt", "some data")
+        url = '/projects/feed/file/%d/log.txt' % datastore_file.key().id()
+        response = self.app.get(url)
+        etag = response.headers['ETag']
+        self.assertTrue("immutable" in response.headers['Cache-Control'])
+        response = self.app.get(url, headers={'If-None-Match': etag})
+        self.assertEquals("304 Not Modified", response.status)
+        response = self.app.get(url, headers={'If-None-Match': 'W/' + etag})
+        self.assertEquals("304 Not Modified", response.status)
+        # If-Range only matches the strong ETag
+        response = self.app.get(url, headers={'Range': 'bytes=0-3', 'If-Range': 'W/' + etag})
+        self.assertEquals("200 OK", response.status)
+        response = self.app.get(url, headers={'Range': 'bytes=0-3', 'If-Range': '"old"'})
+        self.assertEquals("200 OK", response.status)
+        response = self.app.get(url, headers={'Range': 'bytes=0-3', 'If-Range': etag})
+        self.assertEquals("206 Partial Content", response.status)
+        # the whole of the new version, not a 416 for the old one's range
+        response = self.app.get(url, headers={'Range': 'bytes=60-', 'If-Range': '"old"'})
+        self.assertEquals("200 OK", response.status)
+        self.assertEquals("some data", response.body)
+
+    def test_uploads_share_content(self):
+        self.create_issues(0)
+        other = Project(name="other", user=users.User("test@example.com"))
+        other.put()
+        self.app.post('/projects/feed/upload/', upload_files=[('file', 'shot.png', 'same data')])
+        self.app.post('/projects/other/upload/', upload_files=[('file', 'copy.png', 'same data')])
+        self.assertEquals(2, DatastoreFile.all().count())
+        self.assertEquals(1, FileBlob.all().count())
+        self.assertEquals(2, FileBlob.all().get().references)
+        self.assertEquals(1, FileChunk.all().count())
+
+    def test_failed_file_put_releases_blob(self):
+        project = self.create_issues(0)
+        DatastoreFile.create(project, "kept.txt", "text/plain", "same data")
+        def fail(self):
+            raise db.Timeout()
+        put = DatastoreFile.put
+        DatastoreFile.put = fail
+        try:
+            self.assertRaises(db.Timeout, DatastoreFile.create, project, "lost.txt", "text/plain", "same data")
+        finally:
+            DatastoreFile.put = put
+        self.assertEquals(1, FileBlob.all().get().references)
+
+    def test_failed_upload_keeps_shared_blob(self):
+        self.create_issues(0)
+        self.app.post('/projects/feed/upload/', upload_files=[('file', 'shot.png', 'same data')])
+        def fail(self):
+            raise db.Timeout()
+        put = DatastoreFile.put
+        DatastoreFile.put = fail
+        try:
+            self.app.post('/projects/feed/upload/', upload_files=[('file', 'copy.png', 'same data')])
+        finally:
+            DatastoreFile.put = put
+        self.assertEquals(1, DatastoreFile.all().count())
+        self.assertEquals(1, FileBlob.all().get().references)
+        self.assertEquals(1, FileChunk.all().count())
+
+        files = DatastoreFile.all().fetch(2)
+        files[0].delete()
+        self.assertEquals(1, FileBlob.all().get().references)
+        response = self.app.get('/projects/other/file/%d/copy.png' % files[1].key().id())
+        self.assertEquals('same data', response.body)
+        files[1].delete()
+        self.assertEquals(0, FileBlob.all().count())
+        self.assertEquals(0, FileChunk.all().count())
+
+    def test_upload_too_large(self):
+        max_size = settings.FILE_MAX_SIZE
+        settings.FILE_MAX_SIZE = 10
+        try:
+            self.create_issues(0)
+            response = self.app.post('/projects/feed/upload/', upload_files=[('file', 'big.txt', 'x' * 100)],
+                expect_errors=True)
+        finally:
+            settings.FILE_MAX_SIZE = max_size
+        self.assertEquals("413 Request Entity Too Large", response.status)
+        self.assertEquals(0, DatastoreFile.all().count())
+        self.assertEquals(0, FileChunk.all().count())
+
+    def test_download_file_without_chunks(self):
+        project = self.create_issues(0)
+        datastore_file = DatastoreFile(data="old data", mimetype="text/plain", project=project, name="old.txt")
+        datastore_file.put()
+        response = self.app.get('/projects/feed/file/%d/old.txt' % datastore_file.key().id())
+        self.assertEquals("old data", response.body)
+
+    def test_download_missing_file(self):
+        response = self.app.get('/projects/feed/file/99/missing.txt', expect_errors=True)
+        self.assertEquals("404 Not Found", response.status)
+
+    def test_activity_bad_cursor(self):
+        response = self.app.get('/activity.json?cursor=nonsense', expect_errors=True)
+        self.assertEquals("400 Bad Request", response.status)
                                        
 if __name__ == "__main__":
     unittest.main()
\ No newline at end of file
@@ -2,7 +2,9 @@
 
 import sys
 import os
+import time
 import unittest
+from StringIO import StringIO
 
 # insert application path
 app_path = os.path.join(
@@ -10,8 +12,14 @@ app_path = os.path.join(
 )
 sys.path.insert(0, app_path)
 
+from google.appengine.api import apiproxy_stub_map
+from google.appengine.api import memcache
+from google.appengine.api.memcache import memcache_stub
 
-from lib import slugify, textile
+from lib import slugify, textile, BoundedTee, write_json_object, RawJson, slices
+from lib import parse_range, etag_matches, read_multipart
+from django.utils import simplejson
+import settings
 
 class SlugifyTest(unittest.TestCase):
 
@@ -25,6 +33,122 @@ class SlugifyTest(unittest.TestCase):
         for input, output in tests:
             self.assertEqual(slugify(input), output)
 
+class BoundedTeeTest(unittest.TestCase):
+
+    def test_copy_kept_under_limit(self):
+        out = StringIO()
+        tee = BoundedTee(out, 10)
+        tee.write("abc")
+        tee.write("def")
+        self.assertEqual("abcdef", out.getvalue())
+        self.assertEqual("abcdef", tee.getvalue())
+
+    def test_copy_dropped_over_limit(self):
+        out = StringIO()
+        tee = BoundedTee(out, 4)
+        tee.write("abc")
+        tee.write("def")
+        tee.write("g")
+        self.assertEqual("abcdefg", out.getvalue())
+        self.assertEqual(None, tee.getvalue())
+
+class SlicesTest(unittest.TestCase):
+
+    def test_slices(self):
+        self.assertEqual([[1, 2], [3, 4], [5]], slices([1, 2, 3, 4, 5], 2))
+        self.assertEqual([[1, 2]], slices([1, 2], 2))
+        self.assertEqual([], slices([], 2))
+
+class WriteJsonTest(unittest.TestCase):
+
+    def test_same_as_dumps(self):
+        def issues():
+            yield u'first \xe9', {'status': 'Open', 'identifier': '#gitbug1'}
+            yield 'second "quoted"', {'status': 'Fixed', 'description': '<p>x</p>'}
+        out = StringIO()
+        write_json_object(out, [('name', 'project'), ('count', 2), ('issues', issues())])
+        expected = {
+            'name': 'project',
+            'count': 2,
+            'issues': dict(issues()),
+        }
+        self.assertEqual(expected, simplejson.loads(out.getvalue()))
+
+    def test_raw_json(self):
+        def issues():
+            yield 'first', RawJson(simplejson.dumps({'status': 'Open'}))
+        out = StringIO()
+        write_json_object(out, [('issues', issues())])
+        self.assertEqual({'issues': {'first': {'status': 'Open'}}}, simplejson.loads(out.getvalue()))
+
+    def test_empty_object(self):
+        def issues():
+            return
+            yield
+        out = StringIO()
+        write_json_object(out, [('issues', issues())])
+        self.assertEqual('{"issues": {}}', out.getvalue())
+
+class RangeTest(unittest.TestCase):
+
+    def test_ranges(self):
+        self.assertEqual((0, 9), parse_range("bytes=0-9", 100))
+        self.assertEqual((5, 99), parse_range("bytes=5-", 100))
+        self.assertEqual((97, 99), parse_range("bytes=-3", 100))
+        self.assertEqual((90, 99), parse_range("bytes=90-200", 100))
+
+    def test_ignored(self):
+        for header in [None, "", "bytes=9-2", "bytes=0-1,4-5", "items=0-1", "bytes=-"]:
+            self.assertEqual(None, parse_range(header, 100))
+
+    def test_not_satisfiable(self):
+        self.assertRaises(ValueError, parse_range, "bytes=100-", 100)
+        self.assertRaises(ValueError, parse_range, "bytes=-0", 100)
+        self.assertRaises(ValueError, parse_range, "bytes=0-1", 0)
+
+    def test_etag_matches(self):
+        self.assertTrue(etag_matches('"a", "b"', '"b"'))
+        self.assertTrue(etag_matches('*', '"b"'))
+        self.assertFalse(etag_matches('"a"', '"b"'))
+        self.assertTrue(etag_matches('W/"a", W/"b"', '"b"'))
+        self.assertFalse(etag_matches('W/"a"', '"b"'))
+        self.assertFalse(etag_matches(None, '"b"'))
+
+class MultipartTest(unittest.TestCase):
+
+    body = "\r\n".join([
+        "--boundary",
+        'Content-Disposition: form-data; name="title"',
+        "",
+        "A title",
+        "--boundary",
+        'Content-Disposition: form-data; name="file"; filename="log.txt"',
+        "Content-Type: text/plain",
+        "",
+        "line one\r\n--bound not the end\r\nline three",
+        "--boundary--",
+        "",
+    ])
+
+    def parse(self, body, block_size):
+        parts = []
+        for kind, value in read_multipart(StringIO(body), "boundary", block_size):
+            if kind == 'part':
+                parts.append([value, ''])
+            else:
+                parts[-1][1] += value
+        return parts
+
+    def test_parts(self):
+        for block_size in [1, 3, 10, 65536]:
+            parts = self.parse(self.body, block_size)
+            self.assertEqual(["A title", "line one\r\n--bound not the end\r\nline three"],
+                [data for headers, data in parts])
+            self.assertEqual("text/plain", parts[1][0]['content-type'])
+
+    def test_ended_early(self):
+        self.assertRaises(ValueError, self.parse, self.body[:-20], 7)
+
 class TextileTest(unittest.TestCase):
     
     def disabled_test_textile(self):
@@ -36,7 +160,33 @@ class TextileTest(unittest.TestCase):
         ]
         for input, output in tests:
             self.assertEqual(textile(input), output)
-                
+
+class TextileFallbackTest(unittest.TestCase):
+    def setUp(self):
+        apiproxy_stub_map.apiproxy = apiproxy_stub_map.APIProxyStubMap()
+        apiproxy_stub_map.apiproxy.RegisterStub('memcache', memcache_stub.MemcacheServiceStub())
+
+    def test_large_description_shown_as_text(self):
+        value = u'*a* <b>' * (settings.TEXTILE_MAX_SIZE / 7 + 1)
+        output = textile(value)
+        self.assertTrue(output.startswith('<pre>*a* &lt;b&gt;'))
+        self.assertEqual(1, memcache.get("textile_fallbacks"))
+
+    def test_slow_description_shown_as_text(self):
+        start = time.time()
+        output = textile(u'*a ' * 10000)
+        self.assertTrue(output.startswith('<pre>*a *a '))
+        self.assertTrue(time.time() - start < settings.TEXTILE_TIMEOUT)
+
+    def test_slow_description_within_budget(self):
+        # the slowest input we know of, just under the size limit
+        start = time.time()
+        textile(u"'a" * (settings.TEXTILE_MAX_SIZE / 2))
+        self.assertTrue(time.time() - start < settings.TEXTILE_TIMEOUT * 1.5)
+
+    def test_small_description_rendered(self):
+        self.assertEqual('<p><strong>a</strong></p>', textile(u'*a*'))
+        self.assertEqual(None, memcache.get("textile_fallbacks"))
                                        
 if __name__ == "__main__":
     unittest.main()
\ No newline at end of file
@@ -0,0 +1,128 @@
+#!/usr/bin/env python
+
+import sys
+import os
+import unittest
+import datetime
+from StringIO import StringIO
+
+# insert application path
+app_path = os.path.join(
+    os.path.realpath(os.path.dirname(__file__)), '../'
+)
+sys.path.insert(0, app_path)
+
+from ext.PyRSS2Gen import RSS2, RSSItem, RawXml, Category, Cloud, Image, Guid, \
+    TextInput, Enclosure, Source, SkipHours, SkipDays
+
+DATE = datetime.datetime(2010, 2, 3, 4, 5, 6)
+
+def sax_xml(obj, encoding="iso-8859-1"):
+    "The XML from the original SAX serializer, or the exception raised"
+    out = StringIO()
+    try:
+        obj.write_sax_xml(out, encoding)
+    except Exception, e:
+        return e.__class__
+    return out.getvalue()
+
+def fast_xml(obj, encoding="iso-8859-1"):
+    "The XML from the string building serializer, or the exception raised"
+    out = StringIO()
+    try:
+        obj.write_xml(out, encoding)
+    except Exception, e:
+        return e.__class__
+    return out.getvalue()
+
+class ExtendedItem(RSSItem):
+    "Item using the publish_extensions hook"
+    def publish_extensions(self, handler):
+        handler.startElement("extra", {"kind": "test"})
+        handler.characters("extended & more")
+        handler.endElement("extra")
+
+class OverriddenItem(RSSItem):
+    "Item replacing publish altogether"
+    def publish(self, handler):
+        handler.startElement("item", {})
+        handler.characters(self.title.upper())
+        handler.endElement("item")
+
+def items():
+    return [
+        RSSItem(title="plain", link="http://example.com/", description="<p>html &amp; text</p>", pubDate=DATE),
+        RSSItem(title=u"unicode \xe9\u2019\u4e2d", description=u"caf\xe9 <b>\u2603</b>"),
+        RSSItem(title="latin-1 \xe9 bytes", link="http://example.com/?a=1&b=2"),
+        RSSItem(description="only a description", author="someone@example.com",
+            categories=["bugs", Category("fixed", "http://example.com/\"q'")],
+            comments="http://example.com/comments", guid="guid-1",
+            enclosure=Enclosure("http://example.com/a.mp3", 1234, "audio/mpeg"),
+            source=Source("GitBug", "http://example.com/rss")),
+        RSSItem(title="guid object", guid=Guid("http://example.com/1"), pubDate="Tue, 02 Feb 2010"),
+        RSSItem(title="not a permalink", guid=Guid("id-2", isPermaLink=0), description=""),
+        ExtendedItem(title="extended", description="with <extra>"),
+        OverriddenItem(title="overridden"),
+    ]
+
+class RSSTest(unittest.TestCase):
+
+    def assertSameXml(self, obj):
+        self.assertTrue(isinstance(sax_xml(obj), str))
+        for encoding in ["iso-8859-1", "utf-8", "ascii"]:
+            self.assertEqual(sax_xml(obj, encoding), fast_xml(obj, encoding))
+
+    def test_minimal_feed(self):
+        self.assertSameXml(RSS2(title="t", link="l", description=""))
+
+    def test_items(self):
+        self.assertSameXml(RSS2(title="Issues <for> & GitBug", link="http://example.com/",
+            description=None, lastBuildDate=DATE, items=items()))
+
+    def test_all_channel_fields(self):
+        self.assertSameXml(RSS2(title=u"t\xe9", link="l", description="d & d",
+            language="en", copyright="(c)", managingEditor="a@example.com",
+            webMaster="b@example.com", pubDate=DATE, lastBuildDate="yesterday",
+            categories=["one", Category("two", "domain")], generator=None, docs=None,
+            cloud=Cloud("example.com", 80, "/rpc", "ping", "xml-rpc"), ttl=60,
+            image=Image("http://example.com/i.png", "image", "http://example.com/", 10, 20, "desc"),
+            rating="G", textInput=TextInput("t", "d", "n", "l"),
+            skipHours=SkipHours([1, 2]), skipDays=SkipDays(["Monday"]), items=items()))
+
+    def test_string_ttl(self):
+        self.assertSameXml(RSS2(title="t", link="l", description="", ttl="5"))
+
+    def test_single_item(self):
+        for item in items():
+            self.assertSameXml(item)
+
+    def test_items_streamed(self):
+        written = []
+        def generate():
+            for item in items():
+                written.append(item)
+                yield item
+        rss = RSS2(title="t", link="l", description="", items=generate())
+        chunks = rss.xml_chunks()
+        chunks.next()
+        self.assertEqual([], written)
+        chunks.next()
+        self.assertEqual(1, len(written))
+
+    def test_raw_xml_items(self):
+        expected = RSS2(title="t", link="l", description="", items=items())
+        raw = RSS2(title="t", link="l", description="",
+            items=[RawXml(item.xml_fragment()) for item in items()])
+        self.assertEqual(sax_xml(expected), sax_xml(raw))
+        self.assertEqual(sax_xml(expected), fast_xml(raw))
+
+    def test_undecodable_bytes(self):
+        item = RSSItem(title="latin-1 \xe9 bytes")
+        self.assertEqual(UnicodeDecodeError, fast_xml(item, "utf-8"))
+
+    def test_to_xml(self):
+        rss = RSS2(title="t", link="l", description="", items=items())
+        self.assertEqual(sax_xml(rss), rss.to_xml())
+
+if __name__ == "__main__":
+    unittest.main()
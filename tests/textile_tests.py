@@ -0,0 +1,239 @@
+#!/usr/bin/env python
+
+import sys
+import os
+import time
+import random
+import unittest
+
+# insert application path
+app_path = os.path.join(
+    os.path.realpath(os.path.dirname(__file__)), '../'
+)
+sys.path.insert(0, app_path)
+
+from ext.textile import textile, stats, TextileStats, TextileTimeout, _HTMLSanitizer, _StreamSanitizer
+
+# markup the sanitizers should agree on, including hostile input
+SANITIZER_CORPUS = [
+    '',
+    'plain text',
+    '<p>A paragraph</p>',
+    '<p class="x" id="y" onclick="evil()">text</p>',
+    '<script src="evil">evil</script>',
+    '<SCRIPT>alert(1)</SCRIPT>after',
+    '<script><script>nested</script>still hidden</script>shown',
+    '</script>hidden after a stray close',
+    '<applet code="x">applet</applet>',
+    '<a href="javascript:alert(1)" title="&quot;hi&quot;">link</a>',
+    '<a href=\'single\' title=unquoted rel="NoFollow">x</a>',
+    '<a title="x>y">broken</a>',
+    '<a title="&#8217;quote&#8217;">unicode</a>',
+    '<a title="&#65;&#66x&amp;&foo;&bar">refs</a>',
+    '<img src="a.png" alt="" />',
+    '<img src="a.png"><br><hr noshade>',
+    '<br/>shorttag/',
+    '<b/bold/ text',
+    '<>repeat last tag',
+    '<i>x</i><>again</>',
+    '</>',
+    '&amp; &lt; &#169; &#x41; &nbsp &copy x &#12',
+    'a < b > c & d',
+    '<1 not a tag',
+    '<!-- a comment -->',
+    '<!-- comment -- >',
+    '<!DOCTYPE html PUBLIC "-//W3C//DTD HTML 4.01//EN">text',
+    '<![CDATA[ data ]]>text',
+    '<![if !IE]>conditional<![endif]>',
+    '<?php echo "x"; ?>text',
+    '<!>empty declaration',
+    '<style>body { color: red }</style>',
+    '<iframe src="http://evil"></iframe>',
+    '<table><tr><td colspan="2" onmouseover="x">cell</td></tr></table>',
+    '<math xmlns="http://www.w3.org/1998/Math/MathML" mode="display"><mi>x</mi></math>',
+    '<div style="background:url(javascript:x)">styled</div>',
+    'trailing <a href="unterminated',
+    'trailing <!-- unterminated comment',
+    'trailing &amp',
+    'trailing </p',
+    'trailing <',
+]
+
+# textile input whose rendering is fed through the sanitizers
+TEXTILE_CORPUS = [
+    'h1. Header\n\nA *strong* and _emphasised_ paragraph.',
+    '"link(title)":http://example.com and [1] note\n\nfn1. The note',
+    '* one\n** nested\n* two\n\n# first\n# second',
+    '|_. a|_. b|\n|1|2|\n|(#id). 3|4|',
+    'bc. <script>alert(1)</script>',
+    'pre. <b>kept as text</b>',
+    '<script>alert(1)</script>\n\nnext block',
+    'p(class#id){color:red}[en]. styled',
+    'bq.:http://example.com quoted -- text',
+    '!image.png(alt)!:http://example.com',
+    'Acronym GNU(GNU is Not Unix) and CAPS words',
+    '==<b onmouseover="evil">escaped</b>==',
+]
+
+# fragments used to build random markup
+FRAGMENTS = [
+    '<', '>', '/', '&', ';', '#', '"', "'", '=', ' ', '\n', '!', '?', '-',
+    'a', 'b', 'p', 'script', 'img', 'br', 'title', 'href', 'x', '1', '169',
+    '<p>', '</p>', '<a href="', '<script>', '</script>', '<!--', '-->',
+    '&amp;', '&#8217;', '&#65;', '<br />', '<b/', '<>', '</>',
+]
+
+class DictCache(object):
+    "Dictionary backed cache with the parts of the memcache API we use"
+    def __init__(self):
+        self.data = {}
+        self.sets = []
+
+    def get_multi(self, keys, key_prefix=''):
+        found = {}
+        for key in keys:
+            if key_prefix + key in self.data:
+                found[key] = self.data[key_prefix + key]
+        return found
+
+    def set_multi(self, mapping, time=0, key_prefix=''):
+        self.sets.append(sorted(mapping.keys()))
+        for key, value in mapping.items():
+            self.data[key_prefix + key] = value
+        return []
+
+def sanitize_with(cls, text):
+    "Sanitize the text, returning the output or the exception raised"
+    parser = cls()
+    try:
+        parser.feed(text)
+    except Exception, e:
+        return e.__class__
+    return parser.output()
+
+class SanitizerTest(unittest.TestCase):
+
+    def assertSameOutput(self, text):
+        self.assertEqual(sanitize_with(_HTMLSanitizer, text),
+            sanitize_with(_StreamSanitizer, text), repr(text))
+
+    def test_corpus(self):
+        for text in SANITIZER_CORPUS:
+            self.assertSameOutput(text)
+
+    def test_textile_output(self):
+        for text in TEXTILE_CORPUS:
+            self.assertSameOutput(textile(text))
+
+    def test_random_markup(self):
+        rand = random.Random(1)
+        for i in range(2000):
+            text = ''.join([rand.choice(FRAGMENTS) for j in range(rand.randint(1, 30))])
+            self.assertSameOutput(text)
+
+    def test_repeated_feeds(self):
+        text = ''.join(SANITIZER_CORPUS[:-6])
+        old, new = _HTMLSanitizer(), _StreamSanitizer()
+        for i in range(0, len(text), 7):
+            old.feed(text[i:i+7])
+            new.feed(text[i:i+7])
+        self.assertEqual(old.output(), new.output())
+
+    def test_script_removed(self):
+        output = textile('<script src="evil">evil</script>', sanitize=1)
+        self.assertFalse('script' in output)
+        self.assertFalse('evil' in output)
+
+class BlockCacheTest(unittest.TestCase):
+
+    document = '\n\n'.join([
+        'h1. A long description',
+        'A paragraph with a "lookup link":example and a note[1].',
+        'bc.. some code',
+        'which is extended',
+        'p. Back to a paragraph.',
+        'clear>.',
+        'p. Cleared paragraph.',
+        '[example]http://example.com',
+        'fn1. The note',
+    ])
+
+    def test_same_output(self):
+        cache = DictCache()
+        expected = textile(self.document, sanitize=1)
+        self.assertEqual(expected, textile(self.document, sanitize=1, cache=cache))
+        self.assertEqual(expected, textile(self.document, sanitize=1, cache=cache))
+
+    def test_only_changed_blocks_rendered(self):
+        cache = DictCache()
+        textile(self.document, cache=cache)
+        self.assertEqual(1, len(cache.sets))
+        textile(self.document, cache=cache)
+        self.assertEqual(1, len(cache.sets))
+        edited = self.document.replace('Back to', 'Back again to')
+        self.assertEqual(textile(edited), textile(edited, cache=cache))
+        self.assertEqual(2, len(cache.sets))
+        self.assertEqual(1, len(cache.sets[-1]))
+
+    def test_footnotes_resolved_across_blocks(self):
+        cache = DictCache()
+        textile(self.document, cache=cache)
+        edited = self.document.replace('fn1. The note', 'fn1. A new note')
+        output = textile(edited, cache=cache)
+        self.assertTrue('title="A new note"' in output)
+        self.assertEqual(1, len(cache.sets[-1]))
+
+    def test_link_lookups_change_key(self):
+        cache = DictCache()
+        textile(self.document, cache=cache)
+        edited = self.document.replace('[example]http://example.com', '[example]http://example.org')
+        output = textile(edited, cache=cache)
+        self.assertTrue('href="http://example.org"' in output)
+
+    def test_clear_state_changes_key(self):
+        cache = DictCache()
+        textile(self.document, cache=cache)
+        edited = self.document.replace('clear>.', 'clear<.')
+        self.assertEqual(textile(edited), textile(edited, cache=cache))
+
+class TimeoutTest(unittest.TestCase):
+
+    def test_timeout_raised(self):
+        # each paragraph is quadratic for the strong tag, and
+        # the whole takes several seconds without a timeout
+        value = ('*a ' * 1000 + '\n\n') * 50
+        start = time.time()
+        self.assertRaises(TextileTimeout, textile, value, timeout=0.2)
+        self.assertTrue(time.time() - start < 1.0)
+
+    def test_timeout_after_macros(self):
+        self.assertRaises(TextileTimeout, textile, '{' * 8000, timeout=0.01)
+
+    def test_within_timeout(self):
+        self.assertEqual(textile('h1. Title'), textile('h1. Title', timeout=60))
+
+class ProfileTest(unittest.TestCase):
+
+    def setUp(self):
+        stats.reset()
+
+    def test_phases_recorded(self):
+        textile('h1. Title\n\nA paragraph\n\n* item', sanitize=1, profile=1)
+        phases = stats.phases
+        for phase in ['preprocess', 'grab_links', 'split_text', 'footnotes', 'encode',
+                'sanitize', 'block:header', 'block:paragraph', 'block:ul']:
+            self.assertTrue(phase in phases, phase)
+        self.assertEqual((1, len('A paragraph')), (phases['block:paragraph'][0], phases['block:paragraph'][2]))
+
+    def test_nothing_recorded_by_default(self):
+        textile('h1. Title', sanitize=1)
+        self.assertEqual({}, stats.phases)
+
+    def test_merge_and_report(self):
+        profile = TextileStats()
+        profile.record('fast', 0.1, 10)
+        profile.merge({'slow': (2, 1.0, 20), 'fast': (1, 0.1, 5)})
+        self.assertEqual([('slow', 2, 1.0, 20), ('fast', 2, 0.2, 15)], profile.report())
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,89 @@
+#!/usr/bin/python
+"""
+Microbenchmark for the RSS serializer used for the project and issue feeds.
+
+Serializes a feed of issues, like the ones from ProjectRssHandler, with the
+original SAX based writer and with the string building one, checks they
+produce the same XML and reports the items per second of each.
+
+  python utils/rss_benchmark.py               # a 1,000 item feed
+  python utils/rss_benchmark.py --items 5000
+"""
+
+import os
+import sys
+import time
+import random
+import datetime
+from StringIO import StringIO
+from optparse import OptionParser
+
+# insert application path
+app_path = os.path.join(
+    os.path.realpath(os.path.dirname(__file__)), '../'
+)
+sys.path.insert(0, app_path)
+
+from ext.PyRSS2Gen import RSS2, RSSItem
+
+WORDS = ['the', 'issue', 'when', 'saving', 'project', 'page', 'fails', 'with',
+    'an', 'error', 'after', 'clicking', 'button', 'expected', 'result', 'was',
+    'instead', 'shows', 'blank', 'screen', 'GitBug', 'HTML', 'API', 'fixed']
+
+def sentence(rand, length):
+    "A random sentence made from the words above"
+    return ' '.join([rand.choice(WORDS) for i in range(length)]).capitalize()
+
+def feed(items):
+    "A feed of issues like the project feeds"
+    rand = random.Random(items)
+    date = datetime.datetime(2010, 1, 1)
+    rss = RSS2(
+        title="Issues for GitBug on GitBug",
+        link="http://gitbug.appspot.com/gitbug/",
+        description="",
+        lastBuildDate=date,
+    )
+    for i in range(items):
+        name = sentence(rand, 5)
+        rss.items.append(RSSItem(
+            title=rand.choice([name, "%s (Fixed)" % name]),
+            link="http://gitbug.appspot.com/projects/gitbug/issue-%d/" % i,
+            description=u"<p>%s &#8220;<strong>%s</strong>&#8221; caf\xe9</p>" % (
+                sentence(rand, 20), sentence(rand, 2)),
+            pubDate=date + datetime.timedelta(hours=i),
+        ))
+    return rss
+
+def run(write, rss, passes):
+    "Best time of a number of passes of the writer, and its output"
+    timings = []
+    for i in range(passes):
+        out = StringIO()
+        start = time.time()
+        write(rss, out)
+        timings.append(time.time() - start)
+    return min(timings), out.getvalue()
+
+if __name__ == '__main__':
+    # instantiate the arguments parser
+    PARSER = OptionParser()
+    PARSER.add_option('--items', action='store', dest='items', default=1000,
+        type='int', help="Number of items in the feed")
+    PARSER.add_option('--passes', action='store', dest='passes', default=5,
+        type='int', help="Number of times the feed is serialized")
+    # parse the command arguments
+    (OPTIONS, ARGS) = PARSER.parse_args()
+
+    rss = feed(OPTIONS.items)
+    sax, sax_output = run(RSS2.write_sax_xml, rss, OPTIONS.passes)
+    fast, fast_output = run(RSS2.write_xml, rss, OPTIONS.passes)
+
+    print "%-8s %10s %12s" % ('writer', 'best s', 'items/s')
+    print "%-8s %10.4f %12.0f" % ('sax', sax, OPTIONS.items / sax)
+    print "%-8s %10.4f %12.0f" % ('fast', fast, OPTIONS.items / fast)
+    print "%.1fx faster" % (sax / fast)
+
+    if sax_output != fast_output:
+        print "the writers produced different XML"
+        sys.exit(1)
@@ -0,0 +1,197 @@
+#!/usr/bin/python
+"""
+Benchmark for the Textile renderer used for issue and project descriptions.
+
+Renders a set of corpora, from short bug reports to inputs written to make
+the Textile regular expressions backtrack, and reports the time of each pass
+and the throughput in KB/s. The results are compared against a stored
+baseline and the run fails if any corpus got slower than the tolerance.
+
+  python utils/textile_benchmark.py            # compare against the baseline
+  python utils/textile_benchmark.py --save     # store a new baseline
+  python utils/textile_benchmark.py --profile  # show the time of each phase
+"""
+
+import os
+import sys
+import time
+import random
+from optparse import OptionParser
+
+try:
+    import json
+except ImportError:
+    from django.utils import simplejson as json
+
+# insert application path
+app_path = os.path.join(
+    os.path.realpath(os.path.dirname(__file__)), '../'
+)
+sys.path.insert(0, app_path)
+
+from ext.textile import textile, stats
+
+BASELINE = os.path.join(os.path.realpath(os.path.dirname(__file__)),
+    'textile_benchmark.json')
+
+WORDS = ['the', 'issue', 'when', 'saving', 'project', 'page', 'fails', 'with',
+    'an', 'error', 'after', 'clicking', 'button', 'expected', 'result', 'was',
+    'instead', 'shows', 'blank', 'screen', 'GitBug', 'HTML', 'API', 'fixed']
+
+def sentence(rand, length=12):
+    "A random sentence made from the words above"
+    return ' '.join([rand.choice(WORDS) for i in range(length)]).capitalize() + '.'
+
+def bug_reports(rand):
+    "Short bug reports like most issues"
+    reports = []
+    for i in range(50):
+        reports.append('\n\n'.join([
+            sentence(rand),
+            '# Open the *project* page\n# Click _save_\n# See the error',
+            'Expected: %s\nActual: %s' % (sentence(rand, 6), sentence(rand, 6)),
+        ]))
+    return reports
+
+def stack_traces(rand):
+    "Long pasted stack traces, with and without a pre block"
+    frames = []
+    for i in range(400):
+        frames.append('  File "/base/data/home/apps/gitbug/%d/main.py", line %d, in get\n'
+            '    issue = Issue.all().filter(\'internal_url =\', "/%s/%s/").fetch(1)[0]'
+            % (i, rand.randint(1, 800), rand.choice(WORDS), rand.choice(WORDS)))
+    trace = 'Traceback (most recent call last):\n%s\nIndexError: list index out of range' % '\n'.join(frames)
+    return [trace, 'pre. ' + trace, 'bc.. ' + trace]
+
+def tables(rand):
+    "Big tables with headers and cell attributes"
+    rows = ['|_. id|_. name|_. status|_. priority|']
+    for i in range(300):
+        rows.append('|%d|%s|(fixed). %s|>. %s|' % (i, sentence(rand, 4),
+            rand.choice(['Open', 'Fixed']), rand.choice(['High', 'Normal', 'Low'])))
+    return ['table(issues). ' + '\n'.join(rows)]
+
+def nested_lists(rand):
+    "Deeply nested ordered and unordered lists"
+    items = []
+    for i in range(200):
+        depth = rand.randint(1, 4)
+        items.append('%s %s' % (rand.choice(['*', '#']) * depth, sentence(rand, 6)))
+    # lists can't start nested
+    items[0] = '* ' + sentence(rand, 6)
+    return ['\n'.join(items)]
+
+def link_heavy(rand):
+    "Text full of links, lookups, images and bare URLs"
+    lines = []
+    for i in range(200):
+        lines.append('See "%s":http://example.com/%d and "the docs":docs, '
+            '!/assets/images/%d.png(screenshot)! or http://gitbug.appspot.com/projects/%d/ '
+            'and mail someone@example.com about it.' % (rand.choice(WORDS), i, i, i))
+    lines.append('[docs]http://code.google.com/appengine/docs/')
+    return ['\n\n'.join(lines)]
+
+def adversarial(rand):
+    "Inputs written to make the regular expressions backtrack"
+    return [
+        '*a ' * 1000,
+        '_' * 2000,
+        '"a":' * 500,
+        '"' + 'x ' * 1000 + '":',
+        '!' + 'a' * 1000 + ' (' * 200,
+        '|' * 1000,
+        '*_-+' * 300,
+        '{' * 2000,
+        'p' + '(' * 2000 + '. x',
+        'http://' + 'a.' * 2000,
+        '<' * 3000,
+    ]
+
+CORPORA = [
+    ('bug_reports', bug_reports),
+    ('stack_traces', stack_traces),
+    ('tables', tables),
+    ('nested_lists', nested_lists),
+    ('link_heavy', link_heavy),
+    ('adversarial', adversarial),
+]
+
+def run_benchmark(passes, profile=0):
+    "Render each corpus a number of times and return the results"
+    results = {}
+    for name, corpus in CORPORA:
+        documents = corpus(random.Random(name))
+        size = sum([len(document) for document in documents])
+        timings = []
+        for i in range(passes):
+            start = time.time()
+            for document in documents:
+                textile(document, sanitize=1, profile=profile)
+            timings.append(time.time() - start)
+        best = min(timings)
+        results[name] = {
+            'bytes': size,
+            'passes': timings,
+            'kbps': size / 1024.0 / max(best, 1e-6),
+        }
+    return results
+
+def report(results, baseline, tolerance):
+    "Print the results and return the names of the corpora which regressed"
+    regressions = []
+    print "%-14s %10s %10s %10s %10s %10s" % ('corpus', 'KB', 'best s', 'worst s', 'KB/s', 'baseline')
+    for name, corpus in CORPORA:
+        result = results[name]
+        line = "%-14s %10.1f %10.4f %10.4f %10.1f" % (name, result['bytes'] / 1024.0,
+            min(result['passes']), max(result['passes']), result['kbps'])
+        if name in baseline:
+            expected = baseline[name]['kbps']
+            line += " %10.1f" % expected
+            if result['kbps'] < expected * (1 - tolerance):
+                line += "  REGRESSION"
+                regressions.append(name)
+        print line
+        print "%-14s %s" % ('', ' '.join(["%.4f" % timing for timing in result['passes']]))
+    return regressions
+
+def report_profile():
+    "Print the time spent in each phase of rendering"
+    print "%-20s %10s %10s %10s" % ('phase', 'calls', 'total s', 'KB')
+    for phase, calls, seconds, size in stats.report():
+        print "%-20s %10d %10.4f %10.1f" % (phase, calls, seconds, size / 1024.0)
+
+if __name__ == '__main__':
+    # instantiate the arguments parser
+    PARSER = OptionParser()
+    PARSER.add_option('--passes', action='store', dest='passes', default=5,
+        type='int', help="Number of times each corpus is rendered")
+    PARSER.add_option('--tolerance', action='store', dest='tolerance', default=0.25,
+        type='float', help="Allowed drop in throughput from the baseline, 0.25 is 25%")
+    PARSER.add_option('--baseline', action='store', dest='baseline', default=BASELINE,
+        help="File the baseline is read from and saved to")
+    PARSER.add_option('--save', action='store_true', dest='save', default=False,
+        help="Save the results as the new baseline")
+    PARSER.add_option('--profile', action='store_true', dest='profile', default=False,
+        help="Show the time spent in each phase of rendering")
+    # parse the command arguments
+    (OPTIONS, ARGS) = PARSER.parse_args()
+
+    results = run_benchmark(OPTIONS.passes, OPTIONS.profile)
+
+    baseline = {}
+    if not OPTIONS.save and os.path.exists(OPTIONS.baseline):
+        baseline = json.load(open(OPTIONS.baseline))
+
+    regressions = report(results, baseline, OPTIONS.tolerance)
+
+    if OPTIONS.profile:
+        report_profile()
+
+    if OPTIONS.save:
+        saved = dict([(name, {'bytes': result['bytes'], 'kbps': round(result['kbps'], 1)})
+            for name, result in results.items()])
+        json.dump(saved, open(OPTIONS.baseline, 'w'), indent=4, sort_keys=True)
+        print "baseline saved to %s" % OPTIONS.baseline
+    elif regressions:
+        print "slower than the baseline: %s" % ', '.join(regressions)
+        sys.exit(1)
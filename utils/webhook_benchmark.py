@@ -0,0 +1,173 @@
+#!/usr/bin/python
+"""
+Benchmark for the webhook used to fix issues from GitHub pushes.
+
+Sets up the app with the same datastore, mail and task queue stubs as the
+functional tests, creates projects with a number of issues and posts
+synthetic pushes of a number of commits to each. The task the webhook
+queues is run straight away. For each push it reports the wall time,
+datastore RPCs and emails sent by the webhook handler and by the task,
+along with the size of the payload and of the task body, then posts the
+same push again to show the cost of a redelivery.
+
+  python utils/webhook_benchmark.py
+  python utils/webhook_benchmark.py --issues 10,1000 --commits 1,100
+"""
+
+import os
+import sys
+import time
+import base64
+import random
+from optparse import OptionParser
+from datetime import datetime
+from webtest import TestApp
+
+from google.appengine.api import apiproxy_stub_map, mail_stub, user_service_stub, datastore_file_stub
+from google.appengine.api.memcache import memcache_stub
+from google.appengine.api.taskqueue import taskqueue_stub
+from google.appengine.api import users
+from google.appengine.ext import db
+from django.utils import simplejson
+
+# insert application path
+app_path = os.path.join(
+    os.path.realpath(os.path.dirname(__file__)), '../'
+)
+sys.path.insert(0, app_path)
+
+import main
+import admin
+from models import Project, Issue, IssueIdentifier, Counter
+
+class RpcCounter(object):
+    "Counts the API calls made, by service"
+    def __init__(self):
+        self.calls = {}
+
+    def count(self, service, call, request, response):
+        "Hook called before every API call"
+        self.calls[service] = self.calls.get(service, 0) + 1
+
+    def reset(self):
+        self.calls = {}
+
+def setup_stubs():
+    "Register the stubs used by the functional tests, returning the task queue"
+    apiproxy_stub_map.apiproxy = apiproxy_stub_map.APIProxyStubMap()
+    apiproxy_stub_map.apiproxy.RegisterStub('mail', mail_stub.MailServiceStub())
+    apiproxy_stub_map.apiproxy.RegisterStub('user', user_service_stub.UserServiceStub())
+    apiproxy_stub_map.apiproxy.RegisterStub('memcache', memcache_stub.MemcacheServiceStub())
+    taskqueue = taskqueue_stub.TaskQueueServiceStub()
+    apiproxy_stub_map.apiproxy.RegisterStub('taskqueue', taskqueue)
+    stub = datastore_file_stub.DatastoreFileStub('temp', '/dev/null', '/dev/null')
+    apiproxy_stub_map.apiproxy.RegisterStub('datastore_v3', stub)
+
+    os.environ['APPLICATION_ID'] = "temp"
+    os.environ['USER_EMAIL'] = "test@example.com"
+    os.environ['SERVER_NAME'] = "example.com"
+    os.environ['SERVER_PORT'] = "80"
+    return taskqueue
+
+def create_project(issues):
+    """
+    A project with a number of open issues. They are saved in batches
+    rather than with Issue.put, which would take a very long time for
+    the bigger projects
+    """
+    project = Project(name="benchmark %d" % issues, user=users.User("test@example.com"))
+    project.put()
+    for start in range(0, issues, 500):
+        batch = []
+        for identifier in range(start + 1, min(start + 500, issues) + 1):
+            batch.append(Issue(
+                name="issue %d" % identifier,
+                description="Issue number %d" % identifier,
+                html="<p>Issue number %d</p>" % identifier,
+                project=project,
+                email="reporter%d@example.com" % identifier,
+                internal_url="/%s/issue-%d/" % (project.slug, identifier),
+                identifier=identifier,
+                modified_date=datetime.now(),
+            ))
+        db.put(batch)
+        db.put([IssueIdentifier.create(project, issue) for issue in batch])
+    Counter(key_name="counter/%s" % project.name, project=project, count=issues).put()
+    return project
+
+def payload(rand, commits, issues, first):
+    "A push of a number of commits, each referencing an issue"
+    data = []
+    for i in range(commits):
+        identifier = (first + i) % issues + 1
+        verb = rand.choice(["Fixes", "Fixes", "Fixes", "Refs"])
+        data.append({
+            'id': '%040x' % rand.getrandbits(160),
+            'message': "%s #gitbug%d, a change to the project" % (verb, identifier),
+        })
+    return simplejson.dumps({'commits': data})
+
+def push(site, worker, taskqueue, counter, project, body):
+    """
+    Post a push to the webhook and run the task it queues, returning
+    the time, datastore RPCs and emails of the handler and the task,
+    and the size of the task bodies
+    """
+    results = []
+
+    counter.reset()
+    start = time.time()
+    site.post('/projects/%s/hook/' % project.slug, {'key': str(project.key()), 'payload': body})
+    results.append((time.time() - start, counter.calls.get('datastore_v3', 0), counter.calls.get('mail', 0)))
+
+    tasks = taskqueue.GetTasks('default')
+    taskqueue.FlushQueue('default')
+    bodies = [base64.b64decode(task['body']) for task in tasks]
+    counter.reset()
+    start = time.time()
+    for task, body in zip(tasks, bodies):
+        worker.post(task['url'], body,
+            {'Content-Type': 'application/x-www-form-urlencoded'})
+    results.append((time.time() - start, counter.calls.get('datastore_v3', 0), counter.calls.get('mail', 0)))
+    results.append(sum([len(body) for body in bodies]))
+    return results
+
+def numbers(value):
+    "List of numbers from a comma separated option"
+    return [int(number) for number in value.split(',')]
+
+if __name__ == '__main__':
+    # instantiate the arguments parser
+    PARSER = OptionParser()
+    PARSER.add_option('--issues', action='store', dest='issues', default='10,1000,50000',
+        help="Comma separated numbers of issues in the projects")
+    PARSER.add_option('--commits', action='store', dest='commits', default='1,100,1000',
+        help="Comma separated numbers of commits in the pushes")
+    # parse the command arguments
+    (OPTIONS, ARGS) = PARSER.parse_args()
+
+    taskqueue = setup_stubs()
+    counter = RpcCounter()
+    apiproxy_stub_map.apiproxy.GetPreCallHooks().Append('benchmark', counter.count)
+    site = TestApp(main.application())
+    worker = TestApp(admin.application())
+    rand = random.Random(1)
+
+    print "%-8s %-8s %-12s %10s %10s %10s %8s %8s %10s %8s %8s" % ('issues', 'commits', 'delivery',
+        'payload', 'task body', 'hook s', 'rpcs', 'emails', 'task s', 'rpcs', 'emails')
+    for issues in numbers(OPTIONS.issues):
+        start = time.time()
+        project = create_project(issues)
+        print "created %d issues in %.1fs" % (issues, time.time() - start)
+
+        # each push references the issues after the last one,
+        # so the smaller pushes aren't all of fixed issues
+        first = 0
+        for commits in numbers(OPTIONS.commits):
+            body = payload(rand, commits, issues, first)
+            first += commits
+            for delivery in ['first', 'redelivered']:
+                (hook, hook_rpcs, hook_emails), (task, task_rpcs, task_emails), size = push(
+                    site, worker, taskqueue, counter, project, body)
+                print "%-8d %-8d %-12s %10d %10d %10.4f %8d %8d %10.4f %8d %8d" % (issues, commits, delivery,
+                    len(body), size, hook, hook_rpcs, hook_emails, task, task_rpcs, task_emails)